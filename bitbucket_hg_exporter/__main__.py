@@ -7,26 +7,45 @@
 # See the LICENSE file in the GitHub repository for further details.
 
 import argparse
-from collections import OrderedDict
-import copy
+from collections import deque, OrderedDict
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import gc
+import hashlib
 import getpass
 import html
+import itertools
 import json
+import mmap
 import queue
+import random
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
 import time
 import os
+import pathlib
 import shutil
+import sqlite3
 import subprocess
 import sys
 from urllib import parse
+try:
+    import orjson
+except ImportError:
+    # orjson is optional but significantly speeds up reading the downloaded data
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    # ijson is optional and lets us read single keys from large JSON files without parsing the whole file
+    ijson = None
 
 #from OpenSSL.SSL import SysCallError
-from distutils.dir_util import copy_tree
 
 from . import hg2git
 from . import __version__ as software_version 
@@ -34,6 +53,73 @@ from .issue_migrate import import_issues_to_github
 
 bitbucket_api_url = 'https://api.bitbucket.org/2.0/'
 github_api_url = 'https://api.github.com/'
+github_repo_url = github_api_url + 'repos/{owner}/{repo_name}'
+github_import_url = github_repo_url + '/import'
+github_import_lfs_url = github_import_url + '/lfs'
+
+# Maximum number of HTTP requests (or other I/O bound jobs) we will have in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+# Maximum number of threads used to overlap reading/writing of the downloaded files
+MAX_CONCURRENT_FILE_IO = 16
+# how many queued BitBucket API URLs to start downloading ahead of the one being processed
+PREFETCH_DEPTH = 2*MAX_CONCURRENT_REQUESTS
+# How many rewritten (small) JSON files to remember, so identical files are only rewritten once (see make_urls_relative)
+REWRITTEN_JSON_CACHE_SIZE = 4096
+# Minimum number of seconds between progress updates
+UPDATE_INTERVAL = 0.25
+# Number of times we will retry an API request that fails to connect before giving up
+# (with the backoff in query_api this is well over an hour, as BitBucket sometimes drops connections when rate limiting)
+MAX_CONNECTION_RETRIES = 20
+
+def make_session():
+    # A session keeps connections alive between requests (avoiding a new TLS handshake every time)
+    # and lets urllib3 handle retrying of transient server errors with backoff
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504], respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+_BB_SESSION = make_session()
+_GH_SESSION = make_session()
+
+class ETagCache(object):
+    # The ETag and body of the last successful response to each GitHub GET request, so that we can make conditional
+    # requests (GitHub doesn't count "304 Not Modified" responses against the rate limit).
+    # Once a project is opened (see open) they are stored in a SQLite database next to project.json, so that resumed
+    # runs can make conditional requests too. Until then they are only kept in memory
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__db = None
+
+    def open(self, project_path):
+        db = sqlite3.connect(os.path.join(project_path, 'etag_cache.sqlite'), check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS etags (key TEXT PRIMARY KEY, etag TEXT, body BLOB)')
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+            self.__db = db
+            self.__entries = {}
+
+    def get(self, key):
+        # returns (etag, body) or None
+        with self.__lock:
+            if self.__db is None:
+                return self.__entries.get(key, None)
+            row = self.__db.execute('SELECT etag, body FROM etags WHERE key = ?', (key,)).fetchone()
+            return (row[0], bytes(row[1])) if row is not None else None
+
+    def set(self, key, etag, body):
+        with self.__lock:
+            if self.__db is None:
+                self.__entries[key] = (etag, body)
+                return
+            self.__db.execute('INSERT OR REPLACE INTO etags VALUES (?, ?, ?)', (key, etag, body))
+            self.__db.commit()
+
+_GH_ETAG_CACHE = ETagCache()
 
 
 def pad_message(msg):
@@ -81,30 +167,55 @@ def bb_endpoint_to_full_url(endpoint):
 def gh_endpoint_to_full_url(endpoint):
     return github_api_url + endpoint
 
-def full_url_to_query(url):
+@functools.lru_cache(maxsize=4096)
+def _full_url_to_query(url):
     split_data = parse.urlsplit(url)
     params = parse.parse_qs(split_data.query)
     endpoint = parse.urlunsplit(list(split_data[0:3])+['',''])
-    return endpoint, params
+    return endpoint, tuple((k, tuple(v)) for k, v in params.items())
 
-def bb_query_api(endpoint, auth, params=None):
+def full_url_to_query(url):
+    # return a fresh params dict each time so callers can modify it without affecting the cache
+    endpoint, params = _full_url_to_query(url)
+    return endpoint, {k: list(v) for k, v in params}
+
+def query_api(session, base_url, endpoint, auth, params=None, data=None, headers=None, service='BitBucket', etag_cache=None):
     if not endpoint.startswith('https://'):
-        endpoint = bb_endpoint_to_full_url(endpoint)
+        endpoint = base_url + endpoint
     endpoint, orig_params = full_url_to_query(endpoint)
     if params is not None:
         orig_params.update(params)
+    cache_key = None
+    cached = None
+    if etag_cache is not None and data is None:
+        cache_key = json.dumps([endpoint, orig_params, auth[0] if auth else None], sort_keys=True)
+        cached = etag_cache.get(cache_key)
+        if cached is not None:
+            headers = dict(headers) if headers is not None else {}
+            headers['If-None-Match'] = cached[0]
     # Catch the API limit
     retry = True
     retry_count = 0
+    error_count = 0
     response = None
     while retry:
         try:
-            response = requests.get(endpoint, params=orig_params, auth=auth)
+            response = session.get(endpoint, params=orig_params, auth=auth, data=data, headers=headers)
+            rate_limited = response.status_code == 429 or (response.status_code == 403 and response.headers.get('X-RateLimit-Remaining', None) == '0')
+            if rate_limited and ('X-RateLimit-Reset' in response.headers or response.headers.get('Retry-After', '').isdigit()):
+                # The API told us when we can try again, so only sleep until then
+                if 'X-RateLimit-Reset' in response.headers:
+                    wait = max(1, int(response.headers['X-RateLimit-Reset']) - int(time.time())) + 1
+                else:
+                    wait = int(response.headers['Retry-After']) + 1
+                print(pad_message('({}) {} API limit exceeded. Will retry in {} seconds...'.format(auth[0], service, wait)))
+                time.sleep(wait)
+                continue
             if response.status_code == 429:
                 retry_count += 1
                 if retry_count%5 == 4:
                     mins_wait = retry_count//5 + 1
-                    print(pad_message('({}) BitBucket API limit likely exceeded. Will retry in {} mins...'.format(auth[0], mins_wait)))
+                    print(pad_message('({}) {} API limit likely exceeded. Will retry in {} mins...'.format(auth[0], service, mins_wait)))
                     # TODO: make this a sleep(1) in a loop that checks elapsed time, so that PC hibernate negates the sleep
                     time.sleep(60*mins_wait)
                 else:
@@ -112,14 +223,14 @@ def bb_query_api(endpoint, auth, params=None):
                 continue
             retry = False
         except (requests.exceptions.SSLError, requests.exceptions.ConnectionError):
-            retry_count += 1
-            if retry_count%5 == 4:
-                mins_wait = retry_count//5 + 1
-                print(pad_message('({}) BitBucket API limit likely exceeded. Will retry in {} mins...'.format(auth[0], mins_wait)))
-                # TODO: make this a sleep(1) in a loop that checks elapsed time, so that PC hibernate negates the sleep
-                time.sleep(60*mins_wait)
-            else:
-                time.sleep(5)
+            # These are usually transient network problems rather than the API limit, so back off from 30 seconds
+            # up to 5 minutes, and give up eventually rather than looping forever
+            error_count += 1
+            if error_count > MAX_CONNECTION_RETRIES:
+                raise
+            wait = min(30*2**(error_count-1), 300)
+            print(pad_message('({}) Could not connect to the {} API. Will retry in {} seconds...'.format(auth[0], service, wait)))
+            time.sleep(wait)
             continue
         except BaseException:
             # retry = False
@@ -128,68 +239,414 @@ def bb_query_api(endpoint, auth, params=None):
     if ABORT_EVENT.is_set():
         raise RuntimeError('Raising exception so that the thread ends sooner')
 
+    if cache_key is not None:
+        if response.status_code == 304 and cached is not None:
+            # reuse the body of the previous response (the headers of this one are still current)
+            response.status_code = 200
+            response._content = cached[1]
+        elif response.status_code == 200 and 'ETag' in response.headers:
+            etag_cache.set(cache_key, response.headers['ETag'], response.content)
     return response
 
-def bbapi_json(endpoint, auth, params=None):
-    response = bb_query_api(endpoint, auth, params)
+def response_json(response):
     try:
-        json_response = response.json()
+        json_response = loads_json(response.content)
     except BaseException:
         json_response = None
 
     return response.status_code, json_response
 
+def bb_query_api(endpoint, auth, params=None, session=None):
+    return query_api(session or _BB_SESSION, bitbucket_api_url, endpoint, auth, params)
+
+def bbapi_json(endpoint, auth, params=None):
+    return response_json(bb_query_api(endpoint, auth, params))
+
+def bbapi_all_pages(endpoint, auth, params=None):
+    # Returns (status code, list of values from all pages). The values are None if any page failed to download.
+    # Once we know how many pages there are, the remaining pages are fetched concurrently.
+    params = dict(params) if params is not None else {}
+    status, json_response = bbapi_json(endpoint, auth, params)
+    if status != 200 or json_response is None:
+        return status, None
+    values = list(json_response['values'])
+    if 'next' not in json_response:
+        return status, values
+
+    if 'size' in json_response and 'pagelen' in json_response and json_response.get('page', 1) == 1:
+        num_pages = -(-json_response['size'] // json_response['pagelen'])
+        def get_page(page):
+            page_params = dict(params)
+            page_params['page'] = page
+            return bbapi_json(endpoint, auth, page_params)
+        for status, json_response in run_concurrently(get_page, range(2, num_pages+1)):
+            if status != 200 or json_response is None:
+                return status, None
+            values.extend(json_response['values'])
+    else:
+        # The API didn't tell us how many pages there are, so follow the next links one at a time
+        while 'next' in json_response:
+            status, json_response = bbapi_json(json_response['next'], auth, params)
+            if status != 200 or json_response is None:
+                return status, None
+            values.extend(json_response['values'])
+    return status, values
+
 def gh_query_api(endpoint, auth, params=None, data=None, headers=None):
-    if not endpoint.startswith('https://'):
-        endpoint = gh_endpoint_to_full_url(endpoint)
-    endpoint, orig_params = full_url_to_query(endpoint)
-    if params is not None:
-        orig_params.update(params)
-    # Catch the API limit
-    retry = True
-    response = None
-    while retry:
+    return query_api(_GH_SESSION, github_api_url, endpoint, auth, params, data, headers, service='GitHub', etag_cache=_GH_ETAG_CACHE)
+
+def gh_check_repositories(repositories, auth, batch_size=100):
+    # Uses the GraphQL API to check which of a list of (owner, name) repositories exist (and whether each owner
+    # is an organisation) using one request per batch rather than one REST request per repository.
+    # Returns ({(owner, name): exists}, {owner: is_org}) or (None, None) if the GraphQL API could not be queried.
+    repositories = list(repositories)
+    owners = sorted({owner for owner, name in repositories})
+    exists = {}
+    is_org = {}
+    queries = ['r{}: repository(owner: {}, name: {}) {{ name }}'.format(i, json.dumps(owner), json.dumps(name)) for i, (owner, name) in enumerate(repositories)]
+    queries += ['o{}: repositoryOwner(login: {}) {{ __typename }}'.format(i, json.dumps(owner)) for i, owner in enumerate(owners)]
+    for start in range(0, len(queries), batch_size):
         try:
-            response = requests.get(endpoint, params=orig_params, auth=auth, data=data, headers=headers)
-            retry = False
-        except requests.exceptions.SSLError:
-            print('API limit likely exceeded. Will retry in 5 mins...')
-            time.sleep(60*5)
+            response = _GH_SESSION.post(github_api_url + 'graphql', auth=auth, json={'query': 'query {{ {} }}'.format(' '.join(queries[start:start+batch_size]))})
+            data = response.json()['data'] if response.status_code == 200 else None
         except BaseException:
-            # retry = False
-            raise
-    return response
+            data = None
+        if data is None:
+            return None, None
+        for alias, result in data.items():
+            i = int(alias[1:])
+            if alias.startswith('r'):
+                exists[repositories[i]] = result is not None and result['name'] == repositories[i][1]
+            else:
+                is_org[owners[i]] = result is not None and result['__typename'] != 'User'
+    return exists, is_org
 
 def ghapi_json(endpoint, auth, params=None, data=None, headers=None):
-    response = gh_query_api(endpoint, auth, params=params, data=data, headers=headers)
-    try:
-        json_response = response.json()
-    except BaseException:
-        json_response = None
-
-    return response.status_code, json_response
-
-
-def flatten_comments(hierarchy, comments, reordered_comments, depth=0):
-    for h in hierarchy.values():
+    return response_json(gh_query_api(endpoint, auth, params=params, data=data, headers=headers))
+
+def run_concurrently(fn, items, max_workers=MAX_CONCURRENT_REQUESTS):
+    # Calls fn on each item using a pool of threads so that the (I/O bound) calls overlap.
+    # Results are returned in the same order as items. Exceptions are re-raised in the calling thread.
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+
+def clone_urls(repository):
+    # returns a dictionary of BitBucket clone URLs for a repository, keyed by protocol (e.g. 'https', 'ssh')
+    return {clone_link['name']: clone_link['href'] for clone_link in repository['links']['clone']}
+
+
+def run_streamed(cmd, prefix='', cwd=None):
+    # Runs a command, printing its output line by line as it is produced (rather than buffering it all in memory).
+    # Each line is prefixed so output from commands running concurrently can be told apart. Returns the exit code.
+    # The command can't be interactive (a prompt wouldn't be seen), so hg and git are told not to prompt for anything
+    # (e.g. credentials) and fail instead. Use subprocess.call for commands the user may need to interact with.
+    if cmd[0] == 'hg':
+        cmd = [cmd[0], '--noninteractive'] + cmd[1:]
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True, errors='replace')
+    for line in p.stdout:
+        print(prefix + line, end='')
+    return p.wait()
+
+
+def run_vcs(cmd, prefix='', cwd=None, interactive=False):
+    # Runs a hg or git command. Commands run concurrently can't prompt the user (see run_streamed), so if one fails it
+    # should be run again interactively (one at a time, with the terminal) in case it needed credentials
+    if interactive:
+        return subprocess.call(cmd, cwd=cwd)
+    return run_streamed(cmd, prefix=prefix, cwd=cwd)
+
+
+def flatten_comments(hierarchy, comments, depth=0):
+    # depth first walk of the comment tree (using our own stack so deeply nested threads can't hit the recursion limit)
+    reordered_comments = [None]*len(comments)
+    i = 0
+    stack = [(iter(hierarchy.values()), depth)]
+    while stack:
+        children, depth = stack[-1]
+        h = next(children, None)
+        if h is None:
+            stack.pop()
+            continue
         c = comments[h['index']]
         # Add a depth counter so we know how far to indent, epecially if it's breaking nested commenst across pages
         if "parent" in c:
             c['parent']['depth'] = depth
-        reordered_comments.append(c)
-        flatten_comments(h['children'], comments, reordered_comments, depth=depth+1)
+        reordered_comments[i] = c
+        i += 1
+        stack.append((iter(h['children'].values()), depth+1))
+    del reordered_comments[i:]
     return reordered_comments
 
 
+def loads_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# files larger than this are memory mapped (rather than read into memory) before parsing
+MMAP_THRESHOLD = 1024**2
+
+def load_json_file(path):
+    with open(path, 'rb') as f:
+        if orjson is not None and os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as data:
+                    return orjson.loads(data)
+        return loads_json(f.read())
+
+# the contents of at most this many files are kept in memory by read_file_bytes
+FILE_CONTENT_CACHE_SIZE = 1024
+
+@functools.lru_cache(FILE_CONTENT_CACHE_SIZE)
+def read_file_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+# files smaller than this are copied with a single read and write (larger ones are copied in chunks)
+SMALL_FILE_THRESHOLD = 64*1024
+
+def copy_file(src, dst):
+    # (written atomically, see atomic_open)
+    with open(src, 'rb', buffering=0) as fsrc:
+        if os.fstat(fsrc.fileno()).st_size < SMALL_FILE_THRESHOLD:
+            write_file(dst, [fsrc.readall()])
+        else:
+            # (chunks at least as large as the buffer are written straight through it)
+            with atomic_open(dst) as fdst:
+                shutil.copyfileobj(fsrc, fdst, SMALL_FILE_THRESHOLD)
+    return dst
+
+def write_file(path, parts):
+    # Writes the parts (bytes) to path atomically (see atomic_open). Large parts are passed straight through the buffer
+    with atomic_open(path) as f:
+        f.writelines(parts)
+
+def dumps_json(obj, indent=False):
+    # Returns UTF-8 encoded JSON (bytes)
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=4 if indent else None).encode('utf-8')
+
+@contextlib.contextmanager
+def atomic_open(path, mode='wb', **kwargs):
+    # Writes to a temporary file next to path which then replaces path once everything has been written, so that
+    # an interrupted write never leaves a partial file behind (which we would otherwise skip when resuming)
+    tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def dump_json_file(path, obj, indent=False):
+    with atomic_open(path, 'wb') as f:
+        f.write(dumps_json(obj, indent))
+
+def get_next_page(path):
+    # Returns the 'next' link of a paginated JSON file (or None if there isn't one)
+    if ijson is not None:
+        try:
+            with open(path, 'rb') as f:
+                parser = ijson.parse(f)
+                for prefix, event, value in parser:
+                    if prefix == '' and event == 'map_key' and value == 'next':
+                        return next(parser)[2]
+            return None
+        except Exception:
+            # fall back to parsing the entire file
+            pass
+    return load_json_file(path).get('next')
+
+def get_page_links(path, link='links.comments.href'):
+    # Returns a list of the given (dot separated) link from each item in the 'values' of a paginated JSON file,
+    # along with the 'next' link of the file (or None if there isn't one)
+    if ijson is not None:
+        try:
+            links = []
+            next_page = None
+            with open(path, 'rb') as f:
+                for prefix, event, value in ijson.parse(f):
+                    if prefix == 'values.item.' + link and event == 'string':
+                        links.append(value)
+                    elif prefix == 'next' and event == 'string':
+                        next_page = value
+            return links, next_page
+        except Exception:
+            # fall back to parsing the entire file
+            pass
+    data = load_json_file(path)
+    links = []
+    for item in data.get('values', []):
+        for key in link.split('.'):
+            if not isinstance(item, dict) or key not in item:
+                break
+            item = item[key]
+        else:
+            links.append(item)
+    return links, data.get('next', None)
+
+@functools.lru_cache(maxsize=4096)
+def href_to_local_path(root, href):
+    # Converts a (relative) href from the archived JSON data into a local path inside root
+    return os.path.join(root, *pathlib.PurePosixPath(href).parts)
+
 def get_all_pages(data_directory, first_filepath):
     files = []
     while first_filepath is not None:
-        with open(os.path.join(data_directory, *first_filepath.split('/')), 'r') as f:
-            data = json.load(f)
-            files.append(first_filepath)
-            first_filepath = data.get('next')
+        files.append(first_filepath)
+        first_filepath = get_next_page(href_to_local_path(data_directory, first_filepath))
     return files
 
+def run_in_processes(fn, args_list):
+    # Calls fn(*args) for each args in args_list using a pool of processes (for CPU bound jobs).
+    # Results are returned in the same order as args_list. Exceptions are re-raised in the calling process.
+    args_list = list(args_list)
+    if len(args_list) <= 1:
+        return [fn(*args) for args in args_list]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(args_list))) as executor:
+        return list(executor.map(fn, *zip(*args_list)))
+
+def collect_comment_paths(project_path, href):
+    # Walks all pages of a list of pull requests or commits (starting from href) and returns the paths of their comment files
+    comment_paths = []
+    gh_pages_root = os.path.join(project_path, 'gh-pages')
+    page_path = href_to_local_path(gh_pages_root, href)
+    while page_path is not None:
+        comment_links, next_page = get_page_links(page_path)
+        for comment_link in comment_links:
+            comment_paths.append(href_to_local_path(gh_pages_root, comment_link))
+        if next_page is not None:
+            page_path = href_to_local_path(gh_pages_root, next_page)
+        else:
+            page_path = None
+    return comment_paths
+
+def reorder_repository_comments(project_path, repo_data):
+    # Reorders the comments on all pull requests and commits of a repository so that replies follow the comment they
+    # reply to (runs in a separate process, see MigrationProject.__confirm_project_settings)
+
+    # find the links to the comments of every pull request and commit
+    gh_pages_root = os.path.join(project_path, 'gh-pages')
+    comment_paths = []
+    for link_type in ['pullrequests', 'commits']:
+        if "links" in repo_data and link_type in repo_data['links'] and 'href' in repo_data['links'][link_type]:
+            comment_paths.extend(collect_comment_paths(project_path, repo_data['links'][link_type]['href']))
+
+    # Note this code now handles both pull requests and commit comments (despite the variable names)
+    for pull_request_file in comment_paths:
+        comment_files = [pull_request_file]
+        comments = []
+        # Load all comments into RAM, then recursively iterate finding all the ones that have no parent, then all children of the top level, then children of that level, etc. etc. until all comments are placed into a hierarchy. 
+        while pull_request_file:
+            comment_data = load_json_file(pull_request_file)
+            if 'values' in comment_data:
+                comments.extend(comment_data['values'])
+
+            if 'next' in comment_data:
+                pull_request_file = href_to_local_path(gh_pages_root, comment_data['next'])
+                comment_files.append(pull_request_file)
+            else:
+                pull_request_file = None
+
+        # Build the hierarchy in a single pass. Every comment gets a node first, so it doesn't matter if a
+        # reply appears before its parent. Comments whose parent we don't have are placed at the top level.
+        comment_flat = {comment['id']: {'children': OrderedDict(), 'index': i} for i, comment in enumerate(comments)}
+        comment_hierarchy = OrderedDict()
+        for comment in comments:
+            if "parent" in comment and comment['parent']['id'] in comment_flat:
+                parent = comment_flat[comment['parent']['id']]['children']
+            else:
+                parent = comment_hierarchy
+            parent[comment['id']] = comment_flat[comment['id']]
+
+        # Then flatten, split into chunks
+        reordered_comments = flatten_comments(comment_hierarchy, comments)
+        for i, pull_request_file in enumerate(comment_files):
+            with open(pull_request_file, 'r+b') as f:
+                comment_data = loads_json(f.read())
+                if len(reordered_comments) != comment_data['size']:
+                    print('Warning: Something went wrong reordering the pull requests comments in file {}. The number of comments we are writing does not agree with how many there were before we reordered them. There were {} comments, now {} comments'.format(pull_request_file, comment_data['size'], len(reordered_comments)))
+                new_values = reordered_comments[i*100:(i+1)*100]
+                # don't touch files that are already in the correct order (e.g. when re-running on an existing export)
+                if new_values == comment_data['values']:
+                    continue
+                comment_data['values'] = new_values
+                f.seek(0)
+                f.truncate()
+                f.write(dumps_json(comment_data))
+
+def link_repository_hashes(project_path, full_name, repo_mapping):
+    # Adds the git hash, tags and branch to each of the commit JSON files of a repository.
+    # Returns a list of the hg hashes that could not be found in the git repository
+    # (runs in a separate process, see MigrationProject.__confirm_project_settings)
+
+    # load .hgtags file if it exists
+    hg_tags_path = os.path.join(project_path, 'hg-repos', *full_name.split('/'), '.hgtags')
+    hg_tags = {}
+    if os.path.exists(hg_tags_path):
+        with open(hg_tags_path, 'r') as f:
+            for line in f:
+                parts = line.split(' ')
+                node_tags = hg_tags.get(parts[0], [])
+                node_tags.append(" ".join(parts[1:]))
+            
+    commit_path = os.path.join(project_path, 'gh-pages', 'data', 'repositories', *full_name.split('/'), 'commit')
+    # BitBucket gives us full hg hashes, so most commits can be looked up directly (hgnode_to_githash
+    # also handles short hashes and revision numbers, but has to search for them)
+    hg_to_git = repo_mapping.hg_to_git
+    hgnode_to_githash = repo_mapping.hgnode_to_githash
+    hg_branches = repo_mapping.hg_branches
+    def process_commit(path):
+        # Runs in a worker thread. Returns the hg hash if there is no matching git commit
+        # (the file is read and rewritten using a single file handle)
+        with open(path, 'r+b') as f:
+            try:
+                data = loads_json(f.read())
+            except BaseException:
+                print(path)
+                raise
+            previous = (data.get('git_hash', ''), data.get('tags', ''), data.get('branches', ''))
+            # get git hash
+            try:
+                if data['hash'] in hg_to_git:
+                    data['git_hash'] = hg_to_git[data['hash']]
+                else:
+                    data['git_hash'] = hgnode_to_githash(data['hash'])
+            except BaseException:
+                print('Failed to get git hash for BitBucket {} (hash: {})'.format(full_name, data['hash']))
+                data['git_hash'] = None
+            # get tags
+            data['tags'] = hg_tags[data['hash']] if data['hash'] in hg_tags else None
+            # get branch(es) (note: hg log command calls this "branches" but I think there is only ever one branch name for a commit)
+            data['branches'] = 'default'
+            if hg_branches.get(data['hash'], None):
+                data['branches'] = hg_branches[data['hash']]
+            if data['git_hash'] is None:
+                print('Warning: a matching commit for hg_hash:{hg_hash} was not found in the git repository but the BitBucket API for {repo} said that it exists.'.format(hg_hash=data['hash'], repo=full_name))
+
+            # write out the data (unless this file was already linked on a previous run)
+            if previous != (data['git_hash'], data['tags'], data['branches']):
+                f.seek(0)
+                f.truncate()
+                f.write(dumps_json(data))
+        return data['hash'] if data['git_hash'] is None else None
+
+    # The work here is mostly file I/O, so overlap reading/writing the (many, small) commit files using threads
+    with os.scandir(commit_path) as entries:
+        paths = [entry.path for entry in entries if entry.name.endswith('.json') and entry.is_file(follow_symlinks=False)]
+    missing_git_commits = [hg_hash for hg_hash in run_concurrently(process_commit, paths, max_workers=MAX_CONCURRENT_FILE_IO) if hg_hash is not None]
+    return missing_git_commits
+
 import keyring
 KEYRING_SERVICES = {
     'bitbucket': 'bitbucket-to-github-exporter/bitbucket',
@@ -199,6 +656,14 @@ SERVICE_CHECKS = {
     'bitbucket': lambda credentials: bbapi_json('user', credentials),
     'github': lambda credentials: ghapi_json('user', credentials),
 }
+# How long (in seconds) a credential that has been checked against the service is trusted before we check it again
+CREDENTIAL_CHECK_INTERVAL = 600
+
+@functools.lru_cache(maxsize=64)
+def get_keyring_password(service, username):
+    # keyring lookups can be slow (they go via the OS keyring daemon), so only do them once per process
+    return keyring.get_password(KEYRING_SERVICES[service], username)
+
 import questionary as q
 
 class MigrationProject(object):
@@ -207,6 +672,10 @@ class MigrationProject(object):
         for service in KEYRING_SERVICES:
             self.__auth_credentials[service] = {}
 
+        self.__last_saved_settings = None
+        self.__last_save_time = 0
+        self.__save_pending = False
+
         self.__settings = {
             'project_name': '',
             'project_path': '',
@@ -291,8 +760,7 @@ class MigrationProject(object):
             path = os.path.join(location, project_name, 'project.json')
             if os.path.exists(path):
                 try:
-                    with open(path, 'r') as f:
-                        self.__settings.update(json.load(f))
+                    self.__settings.update(load_json_file(path))
                     project_found = True
                 except BaseException:
                     print('Could not load project.json file in {}. It may be corrupted. Please check the formatting and try again'.format(path))
@@ -323,6 +791,8 @@ class MigrationProject(object):
         self.__confirm_project_settings()
 
     def __confirm_project_settings(self, load=False):
+        _GH_ETAG_CACHE.open(self.__settings['project_path'])
+
         # confirm settings before beginning
         while not self.__print_project_settings():
             choices = {
@@ -394,30 +864,31 @@ class MigrationProject(object):
                 self.__settings['github_import_forks_to'] = self.__settings['github_owner']
             self.__save_project_settings()
 
-            all_repo_names = [repository['full_name'] for repository in self.__settings['bb_repositories_to_export']]
-            initial_num_repos = len(all_repo_names)
-            def recursively_process_repositories(repository):
+            all_repo_names = {repository['full_name'] for repository in self.__settings['bb_repositories_to_export']}
+            initial_num_repos = len(self.__settings['bb_repositories_to_export'])
+            def get_forks(repository):
                 if 'links' not in repository or 'forks' not in repository['links'] or 'href' not in repository['links']['forks']:
-                    return
-                status, json_response = bbapi_json(repository['links']['forks']['href'], auth, {'pagelen':100})
-                more = True
-                while more:
-                    if status == 200 and json_response is not None:
+                    return 200, []
+                print('Finding all forks of {}'.format(repository['full_name']))
+                return bbapi_all_pages(repository['links']['forks']['href'], auth, {'pagelen':100})
+
+            def process_repositories(repositories):
+                # breadth first search of the fork tree, querying all repositories at the same depth concurrently
+                to_search = deque(repositories)
+                while to_search:
+                    current_depth = list(to_search)
+                    to_search.clear()
+                    for repository, (status, forks) in zip(current_depth, run_concurrently(get_forks, current_depth)):
+                        if status != 200 or forks is None:
+                            print('Failed to query BitBucket API when determining forks for {}.'.format(repository['full_name']))
+                            sys.exit(0)
                         # process repositories (don't add duplicates)
-                        for r in json_response['values']:
+                        for r in forks:
                             if r['full_name'] not in all_repo_names:
                                 r['is_fork'] = True
                                 self.__settings['bb_repositories_to_export'].append(r)
-                                all_repo_names.append(r['full_name'])
-                                print('Finding all forks of {}'.format(r['full_name']))
-                                recursively_process_repositories(r)
-                        if 'next' in json_response:
-                            status, json_response = bbapi_json(json_response['next'], auth, {'pagelen':100})
-                        else:
-                            more = False
-                    else:
-                        print('Failed to query BitBucket API when determining forks for {}.'.format(repository['full_name']))
-                        sys.exit(0)
+                                all_repo_names.add(r['full_name'])
+                                to_search.append(r)
             
             if self.__settings['backup_forks']:
                 if self.__settings['fork_search_complete']:
@@ -426,10 +897,8 @@ class MigrationProject(object):
                     search = True
 
                 if search:
-                    for repository in self.__settings['bb_repositories_to_export']:
-                        # recursively get list of all forks
-                        print('Finding all forks of {}'.format(repository['full_name']))
-                        recursively_process_repositories(repository)
+                    # get list of all forks (and forks of forks)
+                    process_repositories(self.__settings['bb_repositories_to_export'])
                     self.__settings['fork_search_complete'] = True
             else:
                 # remove forks
@@ -451,12 +920,13 @@ class MigrationProject(object):
                 subset = [[] for _ in auth_list]
                 threads = {}
                 latest_messages = ['' for _ in auth_list]
-                needs_processing = [repo for repo in self.__settings['bb_repositories_to_export'] if repo['full_name'] not in self.__settings['bitbucket_api_download_complete_list']]
+                download_complete = set(self.__settings['bitbucket_api_download_complete_list'])
+                needs_processing = [repo for repo in self.__settings['bb_repositories_to_export'] if repo['full_name'] not in download_complete]
                 for i, repository in enumerate(needs_processing):
                     subset[i%len(auth_list)].append(repository['full_name'])
 
                 def thread_fn(i, message_queue, credentials):
-                    exporter = BitBucketExport(owner, credentials, copy.deepcopy(self.__settings), lambda cmd, message, i=i, q=message_queue:message_queue.put((i,cmd,message)), subset=subset[i])
+                    exporter = BitBucketExport(owner, credentials, dict(self.__settings), lambda cmd, message, i=i, q=message_queue:message_queue.put((i,cmd,message)), subset=subset[i])
                     exporter.backup_api()
                     message_queue.put((i, 'finished', ''))
 
@@ -515,19 +985,14 @@ class MigrationProject(object):
             if self.__settings['bitbucket_hg_download_complete']:
                 do_hg_pull = q.confirm("hg repositories were pulled during a previous run of this script. Do you want to update them?", default=False).ask()
 
-            logs = {}
-            for repository in self.__settings['bb_repositories_to_export']:
+            def clone_or_pull_hg(repository, interactive=False):
+                # Runs in a worker thread, unless interactive (see run_vcs). Returns (log, error message)
                 # TODO: use password from mercurial_keyring (which I think means saving an additional keyring entry with
                 # name and username as <username>@@<repo_url>)
                 clone_dest = os.path.join(self.__settings['project_path'], 'hg-repos', *repository['full_name'].split('/'))
-                clone_url = None
-                for clone_link in repository['links']['clone']:
-                    if clone_link['name'] == 'https':
-                        clone_url = clone_link['href']
-                        break
+                clone_url = clone_urls(repository).get('https', None)
                 if clone_url is None:
-                    print('Failed to determine clone URL for BitBucket repository {}'.format(repository['full_name']))
-                    sys.exit(0)
+                    return None, 'Failed to determine clone URL for BitBucket repository {}'.format(repository['full_name'])
                 clone_dests = [(clone_dest, clone_url)]
 
                 # add path to wiki repository if it has one
@@ -536,20 +1001,31 @@ class MigrationProject(object):
 
                 for clone_dest, clone_url in clone_dests:
                     if not os.path.exists(os.path.join(clone_dest, '.hg', 'hgrc')):
-                        p=subprocess.Popen(['hg', 'clone', clone_url, clone_dest])
-                        p.communicate()
-                        if p.returncode:
-                            print('Failed to hg clone {}'.format(clone_url))
-                            sys.exit(0)
+                        if run_vcs(['hg', 'clone', clone_url, clone_dest], prefix='[{}] '.format(repository['full_name']), interactive=interactive):
+                            return None, 'Failed to hg clone {}'.format(clone_url)
+                        print('Cloned {}'.format(clone_dest))
                     elif do_hg_pull:
-                        p=subprocess.Popen(['hg', 'pull', '-R', clone_dest])
-                        p.communicate()
-                        if p.returncode:
-                            print('Failed to hg update (pull) from {}'.format(clone_url))
-                            sys.exit(0)
+                        if run_vcs(['hg', 'pull', '-R', clone_dest], prefix='[{}] '.format(repository['full_name']), interactive=interactive):
+                            return None, 'Failed to hg update (pull) from {}'.format(clone_url)
+                        print('Updated {}'.format(clone_dest))
 
                 # Generate mapping for rewriting changesets and other items
-                logs[repository['full_name']] = {'hg': hg2git.get_hg_log(clone_dests[0][0])}
+                return hg2git.get_hg_log(clone_dests[0][0]), None
+
+            logs = {}
+            repositories = self.__settings['bb_repositories_to_export']
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_REQUESTS, len(repositories)))) as executor:
+                results = list(executor.map(clone_or_pull_hg, repositories))
+            for repository, (log, error) in zip(repositories, results):
+                if error is not None:
+                    # try again, one at a time, where hg can ask the user for credentials
+                    print(error)
+                    print('Retrying {} interactively'.format(repository['full_name']))
+                    log, error = clone_or_pull_hg(repository, interactive=True)
+                    if error is not None:
+                        print(error)
+                        sys.exit(0)
+                logs[repository['full_name']] = {'hg': log}
 
             self.__settings['bitbucket_hg_download_complete'] = True
             self.__save_project_settings()
@@ -561,18 +1037,42 @@ class MigrationProject(object):
             if self.__settings['import_to_github']:
                 github_auth = (self.__settings['master_github_username'], self.__get_password('github', self.__settings['master_github_username']))
             
+                repositories_by_name = {r['full_name']: r for r in self.__settings['bb_repositories_to_export']}
                 def find_fork_parent(repo):
-                    if 'is_fork' in repo and repo['is_fork']:
+                    # walk up the chain of fork parents until we find the original (non-fork) repository
+                    while 'is_fork' in repo and repo['is_fork']:
                         if 'parent' in repo and 'full_name' in repo['parent']:
-                            parent_name = repo['parent']['full_name']
-                            for r in self.__settings['bb_repositories_to_export']:
-                                if r['full_name'] == parent_name:
-                                    return find_fork_parent(r)
-                            return None
+                            repo = repositories_by_name.get(repo['parent']['full_name'], None)
+                            if repo is None:
+                                return None
                         else:
                             return None
+                    return repo
+
+                def github_repository_name(repository):
+                    # returns the owner and name of the GitHub repository we will import a BitBucket repository to
+                    if 'is_fork' in repository and repository['is_fork']:
+                        github_slug = repository['full_name'].replace('/', '-')
+                        if 'parent' in repository and 'full_name' in repository['parent']:
+                            github_slug += '--forked-from--'+repository['parent']['full_name'].replace('/', '-')
                     else:
-                        return repo
+                        github_slug = repository['slug']
+
+                    # TODO: cap repo name length to 100 chars
+                    github_slug = github_slug[:100]
+                    owner = self.__settings['github_import_forks_to'] if 'is_fork' in repository and repository['is_fork'] else self.__settings['github_owner']
+                    return owner, github_slug
+
+                # check which of the repositories we need to create already exist on GitHub in as few API calls as possible
+                to_check = [github_repository_name(repository) for repository in self.__settings['bb_repositories_to_export'] if repository['full_name'] not in self.__settings['github_existing_repositories'] and (self.__settings['github_import_forks'] or not ('is_fork' in repository and repository['is_fork']))]
+                github_repository_exists, github_owner_is_org = {}, {}
+                if to_check:
+                    github_repository_exists, github_owner_is_org = gh_check_repositories(to_check, github_auth)
+                    if github_repository_exists is None:
+                        # fall back to checking each repository individually below
+                        github_repository_exists, github_owner_is_org = {}, {}
+
+                github_existing_repositories = self.__settings['github_existing_repositories']
                 for repository in self.__settings['bb_repositories_to_export']:
                     # skip forks if we are not importing them to github
                     if not self.__settings['github_import_forks']:
@@ -580,51 +1080,45 @@ class MigrationProject(object):
                             continue
 
                     # update status if we are in an error condition as this determines whether we should try again and we need to make sure we are not working from stale data
-                    if repository['full_name'] in self.__settings['github_existing_repositories'] and self.__settings['github_existing_repositories'][repository['full_name']]['import_started'] and 'import_status' in self.__settings['github_existing_repositories'][repository['full_name']] and self.__settings['github_existing_repositories'][repository['full_name']]['import_status']['status'] == 'error':
-                        import_status_check = requests.get(self.__settings['github_existing_repositories'][repository['full_name']]['import_url'], auth=github_auth, headers=github_headers)
+                    if repository['full_name'] in github_existing_repositories and github_existing_repositories[repository['full_name']]['import_started'] and 'import_status' in github_existing_repositories[repository['full_name']] and github_existing_repositories[repository['full_name']]['import_status']['status'] == 'error':
+                        import_status_check = _GH_SESSION.get(github_existing_repositories[repository['full_name']]['import_url'], auth=github_auth, headers=github_headers)
                         if import_status_check.status_code == 200:
-                            self.__settings['github_existing_repositories'][repository['full_name']]['import_status'] = import_status_check.json()
+                            github_existing_repositories[repository['full_name']]['import_status'] = import_status_check.json()
                         else:
                             pass
                             # handle this nicely
-                    main_condition = repository['full_name'] not in self.__settings['github_existing_repositories'] or not self.__settings['github_existing_repositories'][repository['full_name']]['import_started']
+                    main_condition = repository['full_name'] not in github_existing_repositories or not github_existing_repositories[repository['full_name']]['import_started']
                     error_condition = False
                     if not main_condition:
-                        error_condition = ('import_status' in self.__settings['github_existing_repositories'][repository['full_name']] and self.__settings['github_existing_repositories'][repository['full_name']]['import_status']['status'] == 'error' and self.__settings['github_existing_repositories'][repository['full_name']]['import_status'].get("message", '') != "The imported repository is empty.")
+                        error_condition = ('import_status' in github_existing_repositories[repository['full_name']] and github_existing_repositories[repository['full_name']]['import_status']['status'] == 'error' and github_existing_repositories[repository['full_name']]['import_status'].get("message", '') != "The imported repository is empty.")
                     if main_condition or error_condition:
-                        clone_url = None
-                        for clone_link in repository['links']['clone']:
-                            if clone_link['name'] == 'https':
-                                clone_url = clone_link['href']
-                                break
+                        clone_url = clone_urls(repository).get('https', None)
                         if clone_url is None:
                             print('Failed to determine clone URL for BitBucket repository {}'.format(repository['full_name']))
                             sys.exit(0)
 
                         fork_parent = find_fork_parent(repository)
                         # github_slug = "" if fork_parent is not None else repository['slug']
-                        if 'is_fork' in repository and repository['is_fork']:
-                            github_slug = repository['full_name'].replace('/', '-')
-                            if 'parent' in repository and 'full_name' in repository['parent']:
-                                github_slug += '--forked-from--'+repository['parent']['full_name'].replace('/', '-')
-                        else:
-                            github_slug = repository['slug']
-
-                        # TODO: cap repo name length to 100 chars
-                        github_slug = github_slug[:100]
+                        owner, github_slug = github_repository_name(repository)
+                        import_url = github_import_url.format(owner=owner, repo_name=github_slug)
 
                         # Need to create the repository first! This should allow us to make it private! Yay!
                         # check if repository already exists
-                        owner = self.__settings['github_import_forks_to'] if 'is_fork' in repository and repository['is_fork'] else self.__settings['github_owner']
-                        if repository['full_name'] not in self.__settings['github_existing_repositories']:
-                            status, response = ghapi_json('repos/{owner}/{repo}'.format(owner=owner, repo=github_slug), github_auth)
+                        if repository['full_name'] not in github_existing_repositories:
+                            status = None
+                            if github_repository_exists.get((owner, github_slug), True):
+                                # get the repository information (if we don't know it doesn't exist)
+                                status, response = ghapi_json(github_repo_url.format(owner=owner, repo_name=github_slug), github_auth)
                             if status != 200 or (status == 200 and response['name'] != github_slug):
                                 # find out if owner is a user or org
-                                is_org = False
-                                status, response = ghapi_json('users/{owner}'.format(owner=owner), github_auth)
-                                if status == 200:
-                                    if response['type'] != "User":
-                                        is_org = True
+                                if owner in github_owner_is_org:
+                                    is_org = github_owner_is_org[owner]
+                                else:
+                                    is_org = False
+                                    status, response = ghapi_json('users/{owner}'.format(owner=owner), github_auth)
+                                    if status == 200:
+                                        if response['type'] != "User":
+                                            is_org = True
 
                                 repo_data = {
                                     "name": github_slug,
@@ -638,13 +1132,13 @@ class MigrationProject(object):
                                     repo_data['homepage'] = repository['website']
                                 print('Creating repository {}/{}'.format(owner, github_slug))
                                 if is_org:
-                                    response = requests.post(
+                                    response = _GH_SESSION.post(
                                         'https://api.github.com/orgs/{owner}/repos'.format(owner=owner),  
                                         auth=github_auth, 
                                         json=repo_data
                                     )
                                 else:
-                                    response = requests.post(
+                                    response = _GH_SESSION.post(
                                         'https://api.github.com/user/repos',  
                                         auth=github_auth, 
                                         json=repo_data
@@ -656,7 +1150,7 @@ class MigrationProject(object):
                                 response = response.json()
 
                             # This either uses the initial query of the repository before the if statement, or the response from the creation of the repository
-                            self.__settings['github_existing_repositories'][repository['full_name']] = {
+                            github_existing_repositories[repository['full_name']] = {
                                 'name': '{owner}/{repo_name}'.format(owner=owner, repo_name=github_slug),
                                 'repository': response,
                                 'import_started': False,
@@ -667,7 +1161,7 @@ class MigrationProject(object):
                         # cancel any error requests
                         if error_condition:
                             print('Cancelling import for repository {owner}/{repo_name}) as it was in an error state. We will re-request the import shortly.'.format(owner=owner, repo_name=github_slug))
-                            response = requests.delete('https://api.github.com/repos/{owner}/{repo_name}/import'.format(owner=owner, repo_name=github_slug), auth=github_auth, headers=github_headers)
+                            response = _GH_SESSION.delete(import_url, auth=github_auth, headers=github_headers)
                             if response.status_code != 204:
                                 print('WARNING: Failed to cancel import with error state (repository: {owner}/{repo_name}). We suggest visiting github.com/{owner}/{repo_name} and attempting to restart the import from there.'.format(owner=owner, repo_name=github_slug))
                                 continue
@@ -682,49 +1176,68 @@ class MigrationProject(object):
                             # "vcs_password": auth[1]
                         }
                         print('Requesting source import for repository {}/{}'.format(owner, github_slug))
-                        response = requests.put('https://api.github.com/repos/{owner}/{repo_name}/import'.format(owner=owner, repo_name=github_slug), auth=github_auth, headers=github_headers, json=params)
+                        response = _GH_SESSION.put(import_url, auth=github_auth, headers=github_headers, json=params)
                         if response.status_code != 201:
                             print('Failed to import BitBucket repository {} to GitHub. Response code was: {}'.format(repository['full_name'], response.status_code))
                             sys.exit(0)
-                        self.__settings['github_existing_repositories'][repository['full_name']].update({
+                        github_existing_repositories[repository['full_name']].update({
                             'initial_import_response': response.json(),
-                            'import_url': 'https://api.github.com/repos/{owner}/{repo_name}/import'.format(owner=owner, repo_name=github_slug),
+                            'import_url': import_url,
                             'import_started': True,
                         })
                         self.__save_project_settings()
                         # enable LFS
-                        response = requests.patch('https://api.github.com/repos/{owner}/{repo_name}/import/lfs'.format(owner=owner, repo_name=github_slug), auth=github_auth, headers=github_headers, json={"use_lfs": "opt_in"})
+                        response = _GH_SESSION.patch(github_import_lfs_url.format(owner=owner, repo_name=github_slug), auth=github_auth, headers=github_headers, json={"use_lfs": "opt_in"})
 
                 # wait for all imports to complete
-                all_finished = False
-                while not all_finished:
-                    all_finished = True
-                    for bitbucket_name, github_data in self.__settings['github_existing_repositories'].items():
-                        if 'initial_import_response' not in github_data:
-                            # A hack to handle repos that already existed and were not imported
-                            # (we use this URL later when cloning the GitHub repo)
-                            github_data['import_status'] = {}
-                            github_data['import_status']['repository_url'] = 'https://api.github.com/repos/'+github_data['name']
-                            # Skip checking imprt status for repos we didn't import ourselves
-                            continue
-                        if 'import_status' not in github_data or github_data['import_status']['status'] != 'complete':
-                            # get the current status
-                            response = requests.get(github_data['import_url'], auth=github_auth, headers=github_headers)
-                            if response.status_code != 200:
-                                all_finished = False
-                                print('Failed to check status of import to {}. Will try again next loop.'.format(github_data['name']))
-                                continue
+                pending_imports = []
+                for bitbucket_name, github_data in self.__settings['github_existing_repositories'].items():
+                    if 'initial_import_response' not in github_data:
+                        # A hack to handle repos that already existed and were not imported
+                        # (we use this URL later when cloning the GitHub repo)
+                        github_data['import_status'] = {}
+                        github_data['import_status']['repository_url'] = github_api_url + 'repos/' + github_data['name']
+                        # Skip checking imprt status for repos we didn't import ourselves
+                        continue
+                    if 'import_status' not in github_data or github_data['import_status']['status'] != 'complete':
+                        pending_imports.append(github_data)
+
+                # Each import is polled on its own schedule, backing off (up to a minute) while it is still in progress
+                # so that small imports are picked up quickly and large ones don't waste API calls
+                next_poll = {github_data['name']: (0, 2) for github_data in pending_imports}
+                while pending_imports:
+                    # get the current status of all imports that are due to be checked at once
+                    now = time.time()
+                    due_imports = [github_data for github_data in pending_imports if next_poll[github_data['name']][0] <= now]
+                    responses = run_concurrently(lambda github_data: gh_query_api(github_data['import_url'], github_auth, headers=github_headers), due_imports)
+                    for github_data, response in zip(due_imports, responses):
+                        finished = False
+                        if response.status_code != 200:
+                            print('Failed to check status of import to {}. Will try again shortly.'.format(github_data['name']))
+                        else:
                             github_data['import_status'] = response.json()
                             empty_repo = (github_data['import_status']['status'] == 'error' and github_data['import_status'].get("message", '') == "The imported repository is empty.")
                             if github_data['import_status']['status'] != 'complete' and not empty_repo:
                                 print('Waiting on {} to complete. Current status is: {}'.format(github_data['name'],github_data['import_status']['status_text']))
-                                all_finished = False
                             else:
                                 github_data['import_completed'] = True
-                            self.__save_project_settings()
-                    if not all_finished:
-                        print('sleeping for 30 seconds...')
-                        time.sleep(30)
+                                finished = True
+                            self.__save_project_settings(debounce=True)
+
+                        if finished:
+                            pending_imports.remove(github_data)
+                        else:
+                            backoff = next_poll[github_data['name']][1]
+                            next_poll[github_data['name']] = (time.time() + backoff + random.uniform(0, backoff*0.2), min(backoff*2, 60))
+                    if self.__save_pending:
+                        self.__save_project_settings()
+                    if pending_imports:
+                        wait = max(0, min(next_poll[github_data['name']][0] for github_data in pending_imports) - time.time())
+                        # (no need to say anything if the next poll is already, or almost, due)
+                        if wait >= 1:
+                            print('sleeping for {:.0f} seconds...'.format(wait))
+                        if wait > 0:
+                            time.sleep(wait)
 
                 # TODO: send user mappings
 
@@ -733,43 +1246,60 @@ class MigrationProject(object):
                     do_git_pull = q.confirm("git repositories were pulled during a previous run of this script. Do you want to update them?", default=False).ask()
 
                 # clone the Github repos if needed
-                for repository in self.__settings['bb_repositories_to_export']:
-                    # skip forks if we are not importing them to github
-                    if not self.__settings['github_import_forks']:
-                        if 'is_fork' in repository and repository['is_fork']:
-                            continue
-
-                    # get the github repository information
-                    github_data = self.__settings['github_existing_repositories'][repository['full_name']]
-                    response = requests.get(github_data['import_status']['repository_url'], auth=github_auth, headers=github_headers)
-                    if response.status_code != 200:
-                        print('Failed to get GitHub repository information for {}'.format(github_data['name']))
-                        sys.exit(0)
-                    github_data['repository'] = response.json()
-                    self.__save_project_settings()
+                def clone_or_pull_git(github_data, interactive=False):
+                    # Runs in a worker thread, unless interactive (see run_vcs). Returns (repository information, log, error message)
+                    # get the github repository information (unless we already have it from a completed import)
+                    if github_data.get('import_completed', False) and github_data.get('repository', None) and 'clone_url' in github_data['repository']:
+                        repository_info = github_data['repository']
+                    else:
+                        response = gh_query_api(github_data['import_status']['repository_url'], github_auth, headers=github_headers)
+                        if response.status_code != 200:
+                            return None, None, 'Failed to get GitHub repository information for {}'.format(github_data['name'])
+                        repository_info = response.json()
 
                     # TODO: use password from github keyring?
                     clone_dest = os.path.join(self.__settings['project_path'], 'git-repos', *github_data['name'].split('/'))
-                    clone_url =  github_data['repository']['clone_url']
+                    clone_url =  repository_info['clone_url']
                     if not os.path.exists(os.path.join(clone_dest, '.git', 'config')):
-                        p=subprocess.Popen(['git', 'clone', clone_url, clone_dest])
-                        p.communicate()
-                        if p.returncode:
-                            print('Failed to git clone {}'.format(clone_url))
-                            sys.exit(0)
+                        if run_vcs(['git', 'clone', clone_url, clone_dest], prefix='[{}] '.format(github_data['name']), interactive=interactive):
+                            return None, None, 'Failed to git clone {}'.format(clone_url)
+                        print('Cloned {}'.format(clone_dest))
                     elif do_git_pull:
-                        p=subprocess.Popen(['git', 'pull', clone_url], cwd=clone_dest)
-                        p.communicate()
-                        if p.returncode:
-                            print('Failed to git update (pull) from {}'.format(clone_url))
+                        if run_vcs(['git', 'pull', clone_url], prefix='[{}] '.format(github_data['name']), cwd=clone_dest, interactive=interactive):
                             if os.path.exists(os.path.join(clone_dest, '.git', 'index')):
-                                sys.exit(0)
+                                return None, None, 'Failed to git update (pull) from {}'.format(clone_url)
                             else:
+                                print('Failed to git update (pull) from {}'.format(clone_url))
                                 print('This is probably because the repository is empty? We\'ll try and continue...')
-
+                        else:
+                            print('Updated {}'.format(clone_dest))
 
                     # Generate mapping for rewriting changesets and other items
-                    logs[repository['full_name']]['git'] = hg2git.get_git_log(clone_dest)
+                    return repository_info, hg2git.get_git_log(clone_dest), None
+
+                repositories = []
+                for repository in self.__settings['bb_repositories_to_export']:
+                    # skip forks if we are not importing them to github
+                    if not self.__settings['github_import_forks']:
+                        if 'is_fork' in repository and repository['is_fork']:
+                            continue
+                    repositories.append(repository)
+                github_repositories = [self.__settings['github_existing_repositories'][repository['full_name']] for repository in repositories]
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_REQUESTS, len(repositories)))) as executor:
+                    results = list(executor.map(clone_or_pull_git, github_repositories))
+                for repository, github_data, (repository_info, log, error) in zip(repositories, github_repositories, results):
+                    if error is not None:
+                        # try again, one at a time, where git can ask the user for credentials
+                        print(error)
+                        print('Retrying {} interactively'.format(github_data['name']))
+                        repository_info, log, error = clone_or_pull_git(github_data, interactive=True)
+                        if error is not None:
+                            print(error)
+                            sys.exit(0)
+                    github_data['repository'] = repository_info
+                    self.__save_project_settings(debounce=True)
+                    logs[repository['full_name']]['git'] = log
 
                 self.__settings['github_git_download_complete'] = True
                 self.__save_project_settings()
@@ -812,55 +1342,54 @@ class MigrationProject(object):
             #     self.__save_project_settings()
 
             # copy the gh-pages template to the project directory
+            gh_pages_root = os.path.join(self.__settings['project_path'], 'gh-pages')
             do_copy = True
-            if os.path.exists(os.path.join(self.__settings['project_path'], 'gh-pages', 'index.html')):
+            if os.path.exists(os.path.join(gh_pages_root, 'index.html')):
                 do_copy = q.confirm('Overwrite HTML app for GitHub pages site with latest version?').ask()
                 if do_copy:
                     # delete old version
                     try:
-                        os.remove(os.path.join(self.__settings['project_path'], 'gh-pages', 'index.html'))
+                        os.remove(os.path.join(gh_pages_root, 'index.html'))
                     except BaseException:
                         pass
                     try:
-                        shutil.rmtree(os.path.join(self.__settings['project_path'], 'gh-pages', 'ng'))
+                        shutil.rmtree(os.path.join(gh_pages_root, 'ng'))
                     except BaseException:
                         pass
             if do_copy:
-                copy_tree(os.path.join(os.path.dirname(__file__), 'gh-pages-template'), os.path.join(self.__settings['project_path'], 'gh-pages'))
+                # copy_file replaces each file rather than writing into it, so any hard links to the installed template
+                # (made by earlier versions) are broken rather than overwritten
+                shutil.copytree(os.path.join(os.path.dirname(__file__), 'gh-pages-template'), gh_pages_root, dirs_exist_ok=True, copy_function=copy_file)
 
             # write out a list of downloaded repos and a link to their top level JSON file and other important JSON files
             top_level_repo_data = {}
-            with open(os.path.join(self.__settings['project_path'], 'gh-pages', 'repos.json'), 'w') as f:
-                data = {}
-                for repository in self.__settings['bb_repositories_to_export']:
-                    data[repository['full_name']] = {
-                        'project_file': 'data/repositories/{}.json'.format(repository['full_name']),
-                        'project_path': 'data/repositories/{}/'.format(repository['full_name']),
-                        'is_fork': 'is_fork' in repository and repository['is_fork'],
-                    }
+            data = {}
+            for repository in self.__settings['bb_repositories_to_export']:
+                data[repository['full_name']] = {
+                    'project_file': 'data/repositories/{}.json'.format(repository['full_name']),
+                    'project_path': 'data/repositories/{}/'.format(repository['full_name']),
+                    'is_fork': 'is_fork' in repository and repository['is_fork'],
+                }
+
+                # save github repo location (so we can link to changesets, files, etc)
+                if repository['full_name'] in self.__settings['github_existing_repositories']:
+                    data[repository['full_name']]['github_repo'] = self.__settings['github_existing_repositories'][repository['full_name']]['repository']['html_url']
+
+                # load the top level JSON file for each project as we will use it more than once
+                data_path = os.path.join(gh_pages_root, 'data', 'repositories', *repository['full_name'].split('/'))
+                top_level_repo_data[repository['full_name']] = load_json_file(data_path + '.json')
 
-                    # save github repo location (so we can link to changesets, files, etc)
-                    if repository['full_name'] in self.__settings['github_existing_repositories']:
-                        data[repository['full_name']]['github_repo'] = self.__settings['github_existing_repositories'][repository['full_name']]['repository']['html_url']
-
-                    # load the top level JSON file for each project as we will use it more than once
-                    data_path = os.path.join(self.__settings['project_path'], 'gh-pages', 'data', 'repositories', *repository['full_name'].split('/'))
-                    pull_request_path = None
-                    with open(data_path + '.json', 'r') as g:
-                        top_level_repo_data[repository['full_name']] = json.load(g)
-
-                    # if "links" in top_level_repo_data[repository['full_name']]:
-                    #     # write out links to issue files, pull requests, etc.
-                    #     for link_type in ['issues', 'pullrequests']:
-                    #         link_filepaths = get_all_pages(
-                    #             os.path.join(self.__settings['project_path'], 'gh-pages'),
-                    #             top_level_repo_data[repository['full_name']]['links'].get(link_type, {}).get('href')
-                    #         )
-                    #         data[repository['full_name']]['{}_files'.format(link_type)] = dict(enumerate(link_filepaths, 1))
-                json.dump(data, f, indent=4)
-
-            with open(os.path.join(self.__settings['project_path'], 'gh-pages', 'user_mapping.json'), 'w') as f:
-                json.dump(self.__settings['bb_gh_user_mapping'], f, indent=4)
+                # if "links" in top_level_repo_data[repository['full_name']]:
+                #     # write out links to issue files, pull requests, etc.
+                #     for link_type in ['issues', 'pullrequests']:
+                #         link_filepaths = get_all_pages(
+                #             gh_pages_root,
+                #             top_level_repo_data[repository['full_name']]['links'].get(link_type, {}).get('href')
+                #         )
+                #         data[repository['full_name']]['{}_files'.format(link_type)] = dict(enumerate(link_filepaths, 1))
+            dump_json_file(os.path.join(gh_pages_root, 'repos.json'), data, indent=True)
+
+            dump_json_file(os.path.join(gh_pages_root, 'user_mapping.json'), self.__settings['bb_gh_user_mapping'], indent=True)
 
             # TODO: write out a site pages list for search indexing
 
@@ -869,94 +1398,7 @@ class MigrationProject(object):
             print('Reordering comments...')
             
             if not self.__settings['reorder_comments_complete']:
-                for repository in self.__settings['bb_repositories_to_export']:
-                    # open repo.json file, find location of pull requests list
-                    pull_request_path = None
-                    repo_data = top_level_repo_data[repository['full_name']]
-                    if "links" in repo_data and "pullrequests" in repo_data['links'] and 'href' in repo_data['links']['pullrequests']:
-                        pull_request_path = os.path.join(self.__settings['project_path'], 'gh-pages', *repo_data['links']['pullrequests']['href'].split('/'))
-
-                    # open that file, iterate over each pull requests, and find links to comments
-                    comment_paths = []
-                    while pull_request_path is not None:
-                        with open(pull_request_path, 'r') as f:
-                            pull_requests_data = json.load(f)
-                            for pull_request in pull_requests_data['values']:
-                                if 'links' in pull_request and 'comments' in pull_request['links'] and 'href' in pull_request['links']['comments']:
-                                    comment_paths.append(os.path.join(self.__settings['project_path'], 'gh-pages', *pull_request['links']['comments']['href'].split('/')))
-                            if "next" in pull_requests_data:
-                                pull_request_path = os.path.join(self.__settings['project_path'], 'gh-pages',  *pull_requests_data['next'].split('/'))
-                            else:
-                                pull_request_path = None
-
-                    # find location of commit list
-                    if "links" in repo_data and "commits" in repo_data['links'] and 'href' in repo_data['links']['commits']:
-                        pull_request_path = os.path.join(self.__settings['project_path'], 'gh-pages', *repo_data['links']['commits']['href'].split('/'))
-
-                    # open that file, iterate over each commit, and find links to comments
-                    # TODO: rename variables
-                    while pull_request_path is not None:
-                        with open(pull_request_path, 'r') as f:
-                            pull_requests_data = json.load(f)
-                            for pull_request in pull_requests_data['values']:
-                                if 'links' in pull_request and 'comments' in pull_request['links'] and 'href' in pull_request['links']['comments']:
-                                    comment_paths.append(os.path.join(self.__settings['project_path'], 'gh-pages', *pull_request['links']['comments']['href'].split('/')))
-                            if "next" in pull_requests_data:
-                                pull_request_path = os.path.join(self.__settings['project_path'], 'gh-pages',  *pull_requests_data['next'].split('/'))
-                            else:
-                                pull_request_path = None
-
-                    # Note this code now handles both pull requests and commit comments (despite the variable names)
-                    for pull_request_file in comment_paths:
-                        comment_files = [pull_request_file]
-                        comments = []
-                        # Load all comments into RAM, then recursively iterate finding all the ones that have no parent, then all children of the top level, then children of that level, etc. etc. until all comments are placed into a hierarchy. 
-                        while pull_request_file:
-                            with open(pull_request_file, 'r') as f:
-                                comment_data = json.load(f)
-                                if 'values' in comment_data:
-                                    comments.extend(comment_data['values'])
-
-                                if 'next' in comment_data:
-                                    pull_request_file = comment_data['next']
-                                    comment_files.append(pull_request_file)
-                                else:
-                                    pull_request_file = None
-
-                        done_idxs = []
-                        comment_flat = {}
-                        comment_hierarchy = OrderedDict()
-                        while len(done_idxs) < len(comments):
-                            for i, comment in enumerate(comments):
-                                if i in done_idxs:
-                                    continue
-                                found_parent = False
-                                if "parent" not in comment:
-                                    parent = comment_hierarchy
-                                    found_parent = True
-                                elif comment['parent']['id'] in comment_flat:
-                                    parent = comment_flat[comment['parent']['id']]['children']
-                                    found_parent = True
-
-                                if found_parent:
-                                    done_idxs.append(i)
-                                    d = {
-                                        'children': OrderedDict(),
-                                        'index': i,
-                                    }
-                                    parent[comment['id']] = d
-                                    comment_flat[comment['id']] = d
-                        
-                        # Then flatten, split into chunks
-                        reordered_comments = flatten_comments(comment_hierarchy, comments, [])
-                        for i, pull_request_file in enumerate(comment_files):
-                            with open(pull_request_file, 'r') as f:
-                                comment_data = json.load(f)
-                                comment_data['values'] = reordered_comments[i*100:(i+1)*100]
-                                if len(reordered_comments) != comment_data['size']:
-                                    print('Warning: Something went wrong reordering the pull requests comments in file {}. The number of comments we are writing does not agree with how many there were before we reordered them. There were {} comments, now {} comments'.format(pull_request_file, comment_data['size'], len(reordered_comments)))
-                            with open(pull_request_file, 'w') as f:
-                                json.dump(comment_data, f)
+                run_in_processes(reorder_repository_comments, [(self.__settings['project_path'], top_level_repo_data[repository['full_name']]) for repository in self.__settings['bb_repositories_to_export']])
                 self.__settings['reorder_comments_complete'] = True
                 self.__save_project_settings()
             print('done!')
@@ -969,57 +1411,20 @@ class MigrationProject(object):
             if self.__settings['import_to_github'] and link_hashes:
                 print('Linking git and mercurial hashes...')
                 missing_git_commits = {}
+                repositories = []
                 for repository in self.__settings['bb_repositories_to_export']:
                     # skip forks if we are not importing them to github
                     if not self.__settings['github_import_forks']:
                         if 'is_fork' in repository and repository['is_fork']:
                             continue
-
-                    # load .hgtags file if it exists
-                    hg_tags_path = os.path.join(self.__settings['project_path'], 'hg-repos', *repository['full_name'].split('/'), '.hgtags')
-                    hg_tags = {}
-                    if os.path.exists(hg_tags_path):
-                        with open(hg_tags_path, 'r') as f:
-                            for line in f:
-                                parts = line.split(' ')
-                                node_tags = hg_tags.get(parts[0], [])
-                                node_tags.append(" ".join(parts[1:]))
-                            
-                    repo_api_path = os.path.join(self.__settings['project_path'], 'gh-pages', 'data', 'repositories', *repository['full_name'].split('/'))
-                    for filename in os.listdir(os.path.join(repo_api_path, 'commit')):
-                        if filename.endswith('.json'):
-                            try:
-                                with open(os.path.join(repo_api_path, 'commit', filename), 'r') as f:
-                                    data = json.load(f)
-                            except BaseException:
-                                print(repo_api_path, filename)
-                                raise
-                                sys.exit(1)
-                            # get git hash
-                            try:
-                                data['git_hash'] = mapping[repository['full_name']].hgnode_to_githash(data['hash'])
-                            except BaseException:
-                                print('Failed to get git hash for BitBucket {} (hash: {})'.format(repository['full_name'], data['hash']))
-                                data['git_hash'] = None
-                            # get tags
-                            data['tags'] = hg_tags[data['hash']] if data['hash'] in hg_tags else None
-                            # get branch(es) (note: hg log command calls this "branches" but I think there is only ever one branch name for a commit)
-                            data['branches'] = 'default'
-                            if data['hash'] in mapping[repository['full_name']].hg_branches and mapping[repository['full_name']].hg_branches[data['hash']]:
-                                data['branches'] = mapping[repository['full_name']].hg_branches[data['hash']]
-                            if data['git_hash'] is None:
-                                if repository['full_name'] not in missing_git_commits:
-                                    missing_git_commits[repository['full_name']] = []
-                                missing_git_commits[repository['full_name']].append(data['hash'])
-                                print('Warning: a matching commit for hg_hash:{hg_hash} was not found in the git repository but the BitBucket API for {repo} said that it exists.'.format(hg_hash=data['hash'], repo=repository['full_name']))
-                            
-                            with open(os.path.join(repo_api_path, 'commit', filename), 'w') as f:
-                                # write out the data
-                                json.dump(data, f)
+                    repositories.append(repository)
+                results = run_in_processes(link_repository_hashes, [(self.__settings['project_path'], repository['full_name'], mapping[repository['full_name']]) for repository in repositories])
+                for repository, missing in zip(repositories, results):
+                    if missing:
+                        missing_git_commits[repository['full_name']] = missing
                 if missing_git_commits:
                     filepath = os.path.join(self.__settings['project_path'], 'missing_commits.json')
-                    with open(filepath, 'w') as f:
-                        json.dump(missing_git_commits, f)
+                    dump_json_file(filepath, missing_git_commits)
                     print("WARNING: Some commits could not be matched between hg and git and may indicate some commits were not imported to GitHub correctly (for example, branches with multiple heads). Check carefully that you have not lost commit data in the migration to GitHub. A list of missing commits has been saved to {}.".format(filepath))
                 self.__settings['hash_link_complete'] = True
                 self.__save_project_settings()
@@ -1028,49 +1433,53 @@ class MigrationProject(object):
             # Upload the pages to GitHub
             if self.__settings['import_to_github'] and self.__settings['github_publish_pages']:
                 print('Uploading the archive of BitBucket data to GitHub and activating GitHub pages')
-                clone_dest = os.path.join(self.__settings['project_path'], 'gh-pages')
+                clone_dest = gh_pages_root
                 clone_url = 'https://github.com/{owner}/{repo}'.format(owner=self.__settings['github_owner'], repo=self.__settings['github_pages_repo_name'])
+                # Look up the GitHub repository and owner while we do the (slow) local git work
+                github_lookups = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+                pages_repo_lookup = github_lookups.submit(ghapi_json, 'repos/{owner}/{repo}'.format(owner=self.__settings['github_owner'], repo=self.__settings['github_pages_repo_name']), github_auth)
+                owner_lookup = github_lookups.submit(ghapi_json, 'users/{owner}'.format(owner=self.__settings['github_owner']), github_auth)
+                github_lookups.shutdown(wait=False)
+
+                def git(*args):
+                    # (git may need to ask for credentials, e.g. when pushing)
+                    return subprocess.call(['git'] + list(args), cwd=clone_dest)
+
                 if not os.path.exists(os.path.join(clone_dest, '.git', 'index')):
                     # create repository
-                    p=subprocess.Popen(['git', 'init'], cwd=clone_dest)
-                    p.communicate()
-                    if p.returncode:
+                    if git('init'):
                         print('Failed to run git init for gh-pages folder')
                         sys.exit(0)
 
                     # set remote
-                    p=subprocess.Popen(['git', 'remote', 'add', 'origin', clone_url], cwd=clone_dest)
-                    p.communicate()
-                    if p.returncode:
+                    if git('remote', 'add', 'origin', clone_url):
                         print('Failed to run git init for gh-pages folder')
                         sys.exit(0)
                 else:
                     # pull latest version
-                    p=subprocess.Popen(['git', 'pull', clone_url], cwd=clone_dest)
-                    p.communicate()
-                    if p.returncode:
+                    if git('pull', clone_url):
                         print('WARNING: Failed to git update (pull) from {}'.format(clone_url))
 
+                # The archive contains tens of thousands of small files, so use a smaller index format and cache the
+                # untracked file scan so that staging doesn't have to rewalk the whole tree every time
+                git('config', 'feature.manyFiles', 'true')
+
                 # Stage all changes
-                p=subprocess.Popen(['git', 'add', '.'], cwd=clone_dest)
-                p.communicate()
-                if p.returncode:
+                if git('add', '.'):
                     print('Failed to stage changes in gh-pages folder')
                     sys.exit(0)
 
                 # commit all changes
-                p=subprocess.Popen(['git', 'commit', '-m', "Auto commit by bitbucket_hg_exporter at {}".format(datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))], cwd=clone_dest)
-                p.communicate()
-                if p.returncode:
+                if git('commit', '-m', "Auto commit by bitbucket_hg_exporter at {}".format(datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))):
                     print('Failed to commit changes in gh-pages folder, ignoring because this was probably because there was nothing to commit.')
                     # sys.exit(0)
 
                 # Make GitHub repo if needed
-                status, response = ghapi_json('repos/{owner}/{repo}'.format(owner=self.__settings['github_owner'], repo=self.__settings['github_pages_repo_name']), github_auth)
+                status, response = pages_repo_lookup.result()
                 if status != 200:
                     # find out if owner is a user or org
                     is_org = False
-                    status, response = ghapi_json('users/{owner}'.format(owner=self.__settings['github_owner']), github_auth)
+                    status, response = owner_lookup.result()
                     if status == 200:
                         if response['type'] != "User":
                             is_org = True
@@ -1086,13 +1495,13 @@ class MigrationProject(object):
                     }
 
                     if is_org:
-                        response = requests.post(
+                        response = _GH_SESSION.post(
                             'https://api.github.com/orgs/{owner}/repos'.format(owner=self.__settings['github_owner']),  
                             auth=github_auth, 
                             json=repo_data
                         )
                     else:
-                        response = requests.post(
+                        response = _GH_SESSION.post(
                             'https://api.github.com/user/repos',  
                             auth=github_auth, 
                             json=repo_data
@@ -1104,9 +1513,7 @@ class MigrationProject(object):
 
 
                 # Push to GitHub
-                p=subprocess.Popen(['git', 'push', 'origin', 'master'], cwd=clone_dest)
-                p.communicate()
-                if p.returncode:
+                if git('push', 'origin', 'master'):
                     print('Failed to push changes in gh-pages folder')
                     sys.exit(0)
 
@@ -1119,7 +1526,7 @@ class MigrationProject(object):
                         "path": ""
                     }
                 }
-                response = requests.post(
+                response = _GH_SESSION.post(
                     'https://api.github.com/repos/{owner}/{repo}/pages'.format(owner=self.__settings['github_owner'], repo=self.__settings['github_pages_repo_name']),  
                     auth=github_auth, 
                     headers=github_headers,
@@ -1139,7 +1546,7 @@ class MigrationProject(object):
                 for repository in self.__settings['bb_repositories_to_export']: 
                     bb_repo = repository['full_name']
                     gh_repo = self.__settings['github_existing_repositories'][bb_repo]['repository']['full_name']
-                    import_issues_to_github(bb_repo, gh_repo, github_auth, copy.deepcopy(self.__settings), mapping, dry_run=True)
+                    import_issues_to_github(bb_repo, gh_repo, github_auth, dict(self.__settings), mapping, dry_run=True)
                 print('done! (you can see the results in the "temp/<owner>/<repo>" folder in the project directory)')
 
                 do_import = q.confirm('Do you want to proceed with the import of issues to GitHub (this can only be attempted once)?', default=False).ask()
@@ -1149,7 +1556,7 @@ class MigrationProject(object):
                         bb_repo = repository['full_name']
                         gh_repo = self.__settings['github_existing_repositories'][bb_repo]['repository']['full_name']
                         print('Importing issues from BitBucket/{} to GitHub/{}'.format(bb_repo, gh_repo))
-                        import_issues_to_github(bb_repo, gh_repo, github_auth, copy.deepcopy(self.__settings), mapping, dry_run=False)
+                        import_issues_to_github(bb_repo, gh_repo, github_auth, dict(self.__settings), mapping, dry_run=False)
                     print('done!')
 
                     self.__settings['github_issue_import_complete'] = True
@@ -1165,10 +1572,20 @@ class MigrationProject(object):
         else:
             raise RuntimeError('Unknown option selected')
 
-    def __save_project_settings(self):
+    def __save_project_settings(self, debounce=False):
+        # If debounce is True, the save may be deferred (for up to 2 seconds) until the next call
         self.__settings['__version__'] = software_version
-        with open(os.path.join(self.__settings['project_path'], 'project.json'), 'w') as f:
-            json.dump(self.__settings, f, indent=4)
+        if debounce and time.time() - self.__last_save_time < 2:
+            self.__save_pending = True
+            return
+        self.__save_pending = False
+        self.__last_save_time = time.time()
+        serialized = json.dumps(self.__settings, indent=4)
+        if serialized == self.__last_saved_settings:
+            return
+        with atomic_open(os.path.join(self.__settings['project_path'], 'project.json'), 'w') as f:
+            f.write(serialized)
+        self.__last_saved_settings = serialized
 
     def __get_project_name(self):
         self.__settings['project_name'] = q.text("Enter name for this migration project:").ask()
@@ -1253,23 +1670,8 @@ class MigrationProject(object):
 
         # Get a list of all hg repositories for this user/team and filter by project if+ relevant
         auth = (self.__settings['master_bitbucket_username'], self.__get_password('bitbucket', self.__settings['master_bitbucket_username']))
-        status, json_response = bbapi_json('repositories/{}'.format(self.__settings['bitbucket_repo_owner']), auth, {'q':'scm="hg"', 'pagelen':100})
-
-        bb_repositories = []
-        def recursively_process_repositories(status, json_response, bb_repositories):
-            if status == 200 and json_response is not None:
-                # process repositories
-                bb_repositories.extend(json_response['values'])
-                while 'next' in json_response:
-                    status, json_response = bbapi_json(json_response['next'], auth, {'q':'scm="hg"', 'pagelen':100})
-                    return recursively_process_repositories(status, json_response, bb_repositories)
-            else:
-                return False
-
-            return True
-        
-        success = recursively_process_repositories(status, json_response, bb_repositories)
-        if not success:
+        status, bb_repositories = bbapi_all_pages('repositories/{}'.format(self.__settings['bitbucket_repo_owner']), auth, {'q':'scm="hg"', 'pagelen':100})
+        if bb_repositories is None:
             print('Could not get a list of repositories from BitBucket. Please check the specified repository owner (user/team) is correct and try again.')
             return False
 
@@ -1281,14 +1683,16 @@ class MigrationProject(object):
             return False
 
         # list the repositories so they can be selected for migration
-        choices = [q.Choice(repo['name'], checked=True if not self.__settings['bb_repositories_to_export'] else repo in self.__settings['bb_repositories_to_export']) for repo in bb_repositories]
+        previously_selected = {repo['full_name'] for repo in self.__settings['bb_repositories_to_export']}
+        choices = [q.Choice(repo['name'], checked=True if not previously_selected else repo['full_name'] in previously_selected) for repo in bb_repositories]
         response = q.checkbox('Select repositories to export', choices=choices).ask()
 
         if len(response) == 0:
             print('You did not select any repositories to export. Please try again.')
 
         # save the list of repositories we are going to export
-        self.__settings['bb_repositories_to_export'] = [repo for repo in bb_repositories if repo['name'] in response]
+        selected = set(response)
+        self.__settings['bb_repositories_to_export'] = [repo for repo in bb_repositories if repo['name'] in selected]
 
         return True
 
@@ -1508,11 +1912,17 @@ class MigrationProject(object):
     def __get_password(self, service, username, silent=True, force_new_password=False):
         if not force_new_password:
             # TODO: Look for saved passwords from other applications? (e.g. TortoiseHg)
-            password = self.__auth_credentials[service].get(username, None) or keyring.get_password(KEYRING_SERVICES[service], username)
+            cached = self.__auth_credentials[service].get(username, None)
+            password = cached['password'] if cached is not None else get_keyring_password(service, username)
             
             if password is not None:
-                # check the password works
-                status, _ = SERVICE_CHECKS[service]((username, password))
+                # check the password works (unless we did so recently)
+                if cached is not None and time.time() - cached['verified_at'] < CREDENTIAL_CHECK_INTERVAL:
+                    status = 200
+                else:
+                    status, _ = SERVICE_CHECKS[service]((username, password))
+                    if status == 200:
+                        self.__auth_credentials[service][username] = {'password': password, 'verified_at': time.time()}
                 if status == 200:
                     # If we are just wanting the password, then return it
                     if silent:
@@ -1544,17 +1954,157 @@ class MigrationProject(object):
                 print('Could not authenticate. Please check the password and try again.')
 
         # save credentials in RAM
-        self.__auth_credentials[service][username] = password
+        self.__auth_credentials[service][username] = {'password': password, 'verified_at': time.time()}
 
         # save credentials in keyring?
         save = q.confirm('Save credentials in operating system keyring?').ask()
         if save:
             keyring.set_password(KEYRING_SERVICES[service], username, password)
+            get_keyring_password.cache_clear()
 
         return password
         
 
-prog = re.compile(r'\"{}(.*?)\"'.format(bitbucket_api_url), re.MULTILINE)
+prog = re.compile(r'\"{}(?P<api>.*?)\"'.format(bitbucket_api_url), re.MULTILINE)
+# (for searching the raw bytes of a response, see find_references)
+api_references = re.compile(prog.pattern.encode('utf-8'), re.MULTILINE)
+unsafe_path_characters = re.compile(r'(?u)[^-\w.\/\=\%\{\}]')
+# removed from URLs (wherever they appear) when converting them to save paths
+url_scheme_prefixes = re.compile('|'.join(re.escape(prefix) for prefix in [bitbucket_api_url, 'https://', 'http://']))
+# URLs which aren't valid api endpoints, but BitBucket puts them in the content (see fix_stupid_bitbucket_urls)
+# These (and the other URL rewrites) work on the raw bytes of the downloaded JSON files
+stupid_bitbucket_urls = re.compile(rb'\\\"(https\:\/\/api\.bitbucket\.org\/(.*?)\/(.*?)((\\\")|(\/(.*?))\\\"))', re.MULTILINE)
+stupid_bitbucket_email_links = re.compile(rb'(\\\"\/.*?(\&\#109;\&\#97;\&\#105;\&\#108;\&\#116;\&\#111;\&\#58;)(.*?)\\\")', re.MULTILINE)
+# converts Windows path separators for use in URLs
+url_path_separators = str.maketrans('\\', '/')
+
+def literal_alternation(literals):
+    # longest first so that a literal is never shadowed by one of its own prefixes
+    return b'|'.join(re.escape(literal) for literal in sorted(literals, key=len, reverse=True))
+
+def multi_replace(data, regex, replacements):
+    # Replaces every literal matched by regex (see literal_alternation) in a single pass.
+    # Returns the parts of the result, which can be written out without joining them first (see write_file)
+    parts = []
+    position = 0
+    for match in regex.finditer(data):
+        start, end = match.span()
+        parts.append(data[position:start])
+        parts.append(replacements[match.group()])
+        position = end
+    if not parts:
+        # nothing to replace, so don't copy the data
+        return [data]
+    parts.append(data[position:])
+    return parts
+
+@functools.lru_cache(maxsize=4096)
+def child_url_references(urls):
+    # Anywhere one of urls (the children of a file, as a frozenset) can be replaced by the relative URL of the downloaded
+    # copy (see make_urls_relative): JSON value or escaped HTML image src in JSON, and markdown image format.
+    # Only the children themselves are matched, so they are found anywhere in a JSON string (not just at the start of one)
+    urls = literal_alternation(urls)
+    return re.compile(
+        rb'(?P<quote>\\?")(?P<url>' + urls + rb')(?P=quote)'
+        rb'|\!\[(?P<alt>.*?)\]\((?P<markdown_url>' + urls + rb')\)',
+        re.MULTILINE
+    )
+
+# number of new files recorded in a DownloadIndex between commits to its database
+DOWNLOAD_INDEX_COMMIT_INTERVAL = 1000
+
+class DownloadIndex(object):
+    # Keeps track of the files (and directories) that exist in the BitBucket download directory (root).
+    # The downloaded files are also recorded in a SQLite database next to root, so that resuming an export only needs to
+    # read that rather than walk the (very large) download directory. The directory is only walked the first time
+    # (for projects that were started before the database existed), or if it has been deleted or emptied since the
+    # database was written (in which case the database no longer describes what is on disk). Individual files can still
+    # be deleted by hand, so a file is only reported as present if it also exists on disk.
+    # New files are committed to the database in batches (see commit). Any lost in a crash are just downloaded again
+    # The same index is shared by all BitBucketExport threads (as they download into the same directory)
+    def __init__(self, root):
+        self.__root = root
+        self.__lock = threading.Lock()
+        self.__files = set()
+        self.__directories = set()
+        self.__uncommitted = 0
+
+        db_path = root + '.sqlite'
+        rebuild = not os.path.exists(db_path) or self.__is_empty(root)
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS downloads (path TEXT PRIMARY KEY, url TEXT)')
+        if rebuild:
+            self.__db.execute('DELETE FROM downloads')
+            rows = []
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    rows.append((os.path.relpath(os.path.join(dirpath, filename), root), None))
+            self.__db.executemany('INSERT OR REPLACE INTO downloads VALUES (?, ?)', rows)
+            self.__db.commit()
+
+        # paths are stored relative to root so the project folder can be moved
+        for (path,) in self.__db.execute('SELECT path FROM downloads'):
+            path = os.path.normpath(os.path.join(root, path))
+            self.__files.add(path)
+            self.__directories.add(os.path.dirname(path))
+
+    @staticmethod
+    def __is_empty(root):
+        try:
+            with os.scandir(root) as entries:
+                return next(entries, None) is None
+        except FileNotFoundError:
+            return True
+
+    def __contains__(self, path):
+        path = os.path.normpath(path)
+        if path not in self.__files:
+            return False
+        if os.path.exists(path):
+            return True
+        # it has been deleted since it was downloaded, so forget it (so that it is downloaded again)
+        with self.__lock:
+            self.__files.discard(path)
+            self.__db.execute('DELETE FROM downloads WHERE path = ?', (os.path.relpath(path, self.__root),))
+            self.__uncommitted += 1
+        return False
+
+    def add(self, path, url=None):
+        path = os.path.normpath(path)
+        with self.__lock:
+            if path in self.__files:
+                return
+            self.__files.add(path)
+            self.__db.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?)', (os.path.relpath(path, self.__root), url))
+            self.__uncommitted += 1
+            if self.__uncommitted >= DOWNLOAD_INDEX_COMMIT_INTERVAL:
+                self.__commit()
+
+    def commit(self):
+        with self.__lock:
+            self.__commit()
+
+    def __commit(self):
+        if self.__uncommitted:
+            self.__db.commit()
+            self.__uncommitted = 0
+
+    def make_parent_dirs(self, path):
+        head = os.path.normpath(os.path.dirname(path))
+        if head not in self.__directories:
+            os.makedirs(head, exist_ok=True)
+            self.__directories.add(head)
+
+_download_indexes = {}
+_download_indexes_lock = threading.Lock()
+
+def download_index(root):
+    with _download_indexes_lock:
+        if root not in _download_indexes:
+            _download_indexes[root] = DownloadIndex(root)
+        return _download_indexes[root]
 
 
 
@@ -1572,6 +2122,9 @@ class BitBucketExport(object):
         self.__post_message = post_message
 
         self.__save_path = os.path.join(options['project_path'], 'bitbucket_data_raw')
+        self.__downloaded = download_index(self.__save_path)
+        # each exporter (thread) gets its own connection pool, used for API requests and file downloads
+        self.__session = make_session()
         self.__save_path_relative = os.path.join(options['project_path'], 'gh-pages', 'data')
 
         self.__external_URL_rewrites = {}
@@ -1579,15 +2132,26 @@ class BitBucketExport(object):
             with open(options['github_URL_rewrite_file_path'], 'r') as f:
                 self.__external_URL_rewrites = json.load(f)
 
+        mapping = [repo['full_name'] for repo in self.__options['bb_repositories_to_export']]
+        # links to any exported repository point at its static page, other URLs are rewritten as the user requested.
+        # The repository links come first in the regex so they take precedence over the external rewrites (as they
+        # used to when each was applied in turn)
+        repository_rewrites = {'https://bitbucket.org/{}'.format(name).encode('utf-8'): '#!/{}'.format(name).encode('utf-8') for name in mapping}
+        external_rewrites = {old_url.encode('utf-8'): new_url.encode('utf-8') for old_url, (new_url, _) in self.__external_URL_rewrites.items()}
+        external_rewrites = {old_url: new_url for old_url, new_url in external_rewrites.items() if old_url not in repository_rewrites}
+        self.__url_rewrites = {**external_rewrites, **repository_rewrites}
+        self.__url_rewrites_regex = re.compile(b'|'.join(literal_alternation(rewrites) for rewrites in (repository_rewrites, external_rewrites) if rewrites))
+
         if subset is not None:
+            subset = set(subset)
             self.__repos_to_export = [repo for repo in self.__options['bb_repositories_to_export'] if repo['full_name'] in subset]
         else:
             self.__repos_to_export = self.__options['bb_repositories_to_export']
 
         self.__tree = []
-        self.__current_tree_location = ()
-
-        self.tree_new_level()
+        self.__prefetched = {}
+        self.__prefetched_paths = set()
+        self.__rewrite_cache = {}
 
         # TODO: Save attachments - DONE
         #       Guess file extension from mime type (see https://stackoverflow.com/questions/29674905/convert-content-type-header-into-file-extension)
@@ -1600,7 +2164,6 @@ class BitBucketExport(object):
 
     def backup_api(self):
         self.__repository_list = [tuple(repository['full_name'].split('/')) for repository in self.__options['bb_repositories_to_export']]
-        mapping = [repo['full_name'] for repo in self.__options['bb_repositories_to_export']]
         # print(len(self.__repos_to_export))
         for repository in self.__repos_to_export:
             # this is a bit of a hack but whatever!
@@ -1609,60 +2172,121 @@ class BitBucketExport(object):
             self.__files_downloaded = 0
             self.__duplicates_skipped = 0
             self.__already_downloaded = 0
-            self.__time_of_last_update = time.time()-1
+            self.__time_of_last_update = time.monotonic()-1
             self.__print_update()
-            self.__backup_api()
+            try:
+                self.__backup_api()
+            finally:
+                # (the index is shared, so this also commits files downloaded by other threads so far)
+                self.__downloaded.commit()
             if ABORT_EVENT.is_set():
                 return
             self.__print_update(end="\n", force=True)
             # clear the dummy response cache as we don't need it one we finish with a repository
             self.__dummy_response_cache = {}
+            read_file_bytes.cache_clear()
 
-            self.url_queue = queue.Queue()
-            self.url_queue.put({'mapping':mapping})
-            rewrite_count = 0
             # rewrite URLs in all files
-            while not self.url_queue.empty() and not ABORT_EVENT.is_set():
-                data = self.url_queue.get()
-                self.make_urls_relative(**data)
-                rewrite_count += 1
-                self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {count} files rewritten'.format(repo=self.__repo_full_name, count=rewrite_count), "\r"))
-            # self.make_urls_relative(mapping=mapping)
+            rewrite_count = self.make_urls_relative()
             if ABORT_EVENT.is_set():
                 return
             self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {count} files rewritten'.format(repo=self.__repo_full_name, count=rewrite_count), "\n"))
             self.__post_message('complete', repository['full_name'])
             # reset the tree
             self.__tree = []
-            self.__current_tree_location = ()
-            self.tree_new_level()
 
     def __backup_api(self):    
-        self.file_download_regexes = [
+        self.file_regex, self.issue_regex, ignore_rules, rewrite_rules = self.build_repository_rules(self.__owner, self.__repository)
+        # the rules are specific to this repository
+        self.__rewrite_cache = {}
+
+        self.url_queue = deque()
+        self.url_queue.append(('https://api.bitbucket.org/2.0/repositories/{owner}/{repo}'.format(owner=self.__owner, repo=self.__repository), self.__tree))
+
+        # Backup everything
+        # The URLs are still processed one at a time (in order) so that the tree and duplicate detection work as before,
+        # but the next few URLs in the queue are downloaded in the background while we do so
+        # Saving the downloaded JSON is also done in the background (see get_and_save_json)
+        self.__prefetched = {}
+        self.__prefetched_paths = set()
+        self.__pending_writes = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FILE_IO) as self.__writer:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+                try:
+                    while self.url_queue and not ABORT_EVENT.is_set():
+                        self.__prefetch(executor, rewrite_rules)
+                        url, tree = self.url_queue.popleft()
+                        self.get_and_save_json(url, ignore_rules, rewrite_rules, tree)
+                finally:
+                    for future in self.__prefetched.values():
+                        if future is not None:
+                            future.cancel()
+                    self.__prefetched = {}
+                    self.__prefetched_paths = set()
+        # all files must be written before we start rewriting them (and raise any errors that occurred writing them)
+        for future in self.__pending_writes:
+            future.result()
+        self.__pending_writes = []
+
+    def __save_json(self, endpoint_path, json_data, refs, url):
+        # The links found in the file are saved alongside it (see get_and_save_json)
+        if json_data is not None:
+            dump_json_file(endpoint_path, json_data)
+        dump_json_file(endpoint_path + '.refs', refs)
+        self.__downloaded.add(endpoint_path, url)
+        self.__downloaded.add(endpoint_path + '.refs')
+
+    def __prefetch(self, executor, rewrite_rules):
+        for url, _ in itertools.islice(self.url_queue, PREFETCH_DEPTH):
+            if url in self.__prefetched:
+                continue
+            _, rewritten_base_url, endpoint_path = self.plan_json_request(url, rewrite_rules)
+            # nothing to download if we already have the file (or are about to)
+            if endpoint_path in self.__prefetched_paths or endpoint_path in self.__dummy_response_cache or endpoint_path in self.__downloaded:
+                self.__prefetched[url] = None
+                continue
+            self.__prefetched_paths.add(endpoint_path)
+            self.__prefetched[url] = executor.submit(bb_query_api, rewritten_base_url, auth=self.__credentials, session=self.__session)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def build_repository_rules(owner, repo):
+        # Returns the (compiled) regexes and rules used to crawl the API data of a repository.
+        # These are cached as they are the same every time a repository is backed up
+        file_download_regexes = [
             re.compile(r'\"(https://bitbucket\.org/repo/(?:[a-zA-Z0-9]+)/images/(?:.+?))\\\"', re.MULTILINE), # images in HTML
             re.compile(r'\"(https://pf-emoji-service--cdn\.(?:[a-zA-Z0-9\-]+)\.prod\.public\.atl-paas\.net/(?:.+?))\\\"', re.MULTILINE), # emojis
             re.compile(r'\"(https://secure.gravatar.com/avatar/(?:.+?))\"', re.MULTILINE), # avatars
             re.compile(r'\"(https://bytebucket\.org/(?:.+?))\"', re.MULTILINE), # other things (like language avatars)
             # re.compile(r'\"(https://bytebucket\.org/(?:.+?))\"', re.MULTILINE), # TODO: downloads
-            re.compile(r'\"(https://api\.bitbucket\.org/2\.0/repositories/{owner}/{repo}/issues/(?:\d+)/attachments/(?:.+?))\"'.format(owner=self.__owner, repo=self.__repository), re.MULTILINE), # attachments
+            re.compile(r'\"(https://api\.bitbucket\.org/2\.0/repositories/{owner}/{repo}/issues/(?:\d+)/attachments/(?:.+?))\"'.format(owner=owner, repo=repo), re.MULTILINE), # attachments
         ]
+        # Search for all of them in a single pass over each response (see find_references).
+        # Each file pattern has a single group, so the group that matched is always the last one.
+        # (this is a bytes pattern so we can search the raw response without decoding it first)
+        file_regex = re.compile(
+            '|'.join('(?:{})'.format(regex.pattern) for regex in file_download_regexes).encode('utf-8'),
+            re.MULTILINE
+        )
+        # hack because nothing references issue/<num>/changes for some reason (see get_and_save_json)
+        issue_regex = re.compile(r'repositories/{}/{}/issues/(\d+)$'.format(owner, repo))
 
         # TODO: probably want to save some of these...the question is how far do we go down the tree.
         #       for example, users link to other repos which then result in you saving data for every 
         #       repo for every user, etc, etc.
         ignore_rules = [
-            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/patch'.format(owner=self.__owner, repo=self.__repository)},
-            # {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/commit'.format(owner=self.__owner, repo=self.__repository)},
-            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/diff'.format(owner=self.__owner, repo=self.__repository)},
-            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/src'.format(owner=self.__owner, repo=self.__repository)},
-            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/filehistory'.format(owner=self.__owner, repo=self.__repository)},
-            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/downloads'.format(owner=self.__owner, repo=self.__repository)},
-            {'type': 'startswith', 'not':True, 'string':'repositories/{owner}/{repo}'.format(owner=self.__owner, repo=self.__repository)},
-            {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/issues/import'.format(owner=self.__owner, repo=self.__repository)},
-            {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/issues/export'.format(owner=self.__owner, repo=self.__repository)},
-            {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/hooks'.format(owner=self.__owner, repo=self.__repository)},
+            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/patch'.format(owner=owner, repo=repo)},
+            # {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/commit'.format(owner=owner, repo=repo)},
+            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/diff'.format(owner=owner, repo=repo)},
+            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/src'.format(owner=owner, repo=repo)},
+            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/filehistory'.format(owner=owner, repo=repo)},
+            {'type': 'in', 'not':False, 'string':'repositories/{owner}/{repo}/downloads'.format(owner=owner, repo=repo)},
+            {'type': 'startswith', 'not':True, 'string':'repositories/{owner}/{repo}'.format(owner=owner, repo=repo)},
+            {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/issues/import'.format(owner=owner, repo=repo)},
+            {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/issues/export'.format(owner=owner, repo=repo)},
+            {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/hooks'.format(owner=owner, repo=repo)},
             # Get the list of commits, but not individual commit JSON files
-            # {'type': 'endswith', 'not':True, 'string':'repositories/{owner}/{repo}/commits/'.format(owner=self.__owner, repo=self.__repository)},
+            # {'type': 'endswith', 'not':True, 'string':'repositories/{owner}/{repo}/commits/'.format(owner=owner, repo=repo)},
             {'type': 'endswith', 'not':False, 'string':'/approve'},
             {'type': 'endswith', 'not':False, 'string':'/decline'},
             {'type': 'endswith', 'not':False, 'string':'/merge'},
@@ -1671,24 +2295,24 @@ class BitBucketExport(object):
         ]
 
         pr_ignores = [
-            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/commit/'.format(owner=self.__owner, repo=self.__repository)},
-            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/issues'.format(owner=self.__owner, repo=self.__repository)},
+            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/commit/'.format(owner=owner, repo=repo)},
+            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/issues'.format(owner=owner, repo=repo)},
         ]
 
         issue_ignores = [
-            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/pullrequests/'.format(owner=self.__owner, repo=self.__repository)},
-            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/commit/'.format(owner=self.__owner, repo=self.__repository)},
+            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/pullrequests/'.format(owner=owner, repo=repo)},
+            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/commit/'.format(owner=owner, repo=repo)},
         ]
 
         commit_comments_ignores = [
-            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/issues/'.format(owner=self.__owner, repo=self.__repository)},
-            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/pullrequests/'.format(owner=self.__owner, repo=self.__repository)},
+            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/issues/'.format(owner=owner, repo=repo)},
+            # {'type': 'startswith', 'not':False, 'string':'repositories/{owner}/{repo}/pullrequests/'.format(owner=owner, repo=repo)},
         ]
 
         rewrite_rules = [
             # special case for pull requests
             {
-                'endpoint_match':['repositories/{owner}/{repo}/pullrequests'.format(owner=self.__owner, repo=self.__repository)], 
+                'endpoint_match':['repositories/{owner}/{repo}/pullrequests'.format(owner=owner, repo=repo)], 
                 'rewrites':[
                     {
                         'params_match':{'state':None}, 
@@ -1711,8 +2335,8 @@ class BitBucketExport(object):
             # endpoints that take a max pagelen of 50 but don't have a page by default
             {
                 'endpoint_match':[
-                    re.compile(r'repositories\/{owner}\/{repo}/pullrequests\/(\d+)\/activity(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
-                    'repositories/{owner}/{repo}/pullrequests/activity'.format(owner=self.__owner, repo=self.__repository),
+                    re.compile(r'repositories\/{owner}\/{repo}/pullrequests\/(\d+)\/activity(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
+                    'repositories/{owner}/{repo}/pullrequests/activity'.format(owner=owner, repo=repo),
                 ], 
                 'rewrites':[
                     {
@@ -1728,7 +2352,7 @@ class BitBucketExport(object):
             # endpoints that take a max pagelen of 100 but don't have a page by default
             {
                 'endpoint_match':[
-                    'repositories/{owner}/{repo}/refs/tags'.format(owner=self.__owner, repo=self.__repository),
+                    'repositories/{owner}/{repo}/refs/tags'.format(owner=owner, repo=repo),
                 ], 
                 'rewrites':[
                     {
@@ -1740,8 +2364,8 @@ class BitBucketExport(object):
             # endpoints that take a max pagelen of 100 but don't have a page by default and should be sorted by creation date
             {
                 'endpoint_match':[
-                    re.compile(r'repositories\/{owner}\/{repo}/issues\/(\d+)\/changes(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
-                    re.compile(r'repositories\/{owner}\/{repo}/pullrequests\/(\d+)\/commits(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
+                    re.compile(r'repositories\/{owner}\/{repo}/issues\/(\d+)\/changes(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
+                    re.compile(r'repositories\/{owner}\/{repo}/pullrequests\/(\d+)\/commits(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
                 ], 
                 'rewrites':[
                     {
@@ -1757,13 +2381,13 @@ class BitBucketExport(object):
             # endpoints that take a max pagelen of 100
             {
                 'endpoint_match':[
-                    re.compile(r'repositories\/{owner}\/{repo}/issues\/(\d+)\/attachments(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
-                    'repositories/{owner}/{repo}/components'.format(owner=self.__owner, repo=self.__repository),
-                    'repositories/{owner}/{repo}/milestones'.format(owner=self.__owner, repo=self.__repository),
-                    'repositories/{owner}/{repo}/refs'.format(owner=self.__owner, repo=self.__repository),
-                    'repositories/{owner}/{repo}/refs/branches'.format(owner=self.__owner, repo=self.__repository),
-                    'repositories/{owner}/{repo}/versions'.format(owner=self.__owner, repo=self.__repository),
-                    'repositories/{owner}/{repo}/watchers'.format(owner=self.__owner, repo=self.__repository),
+                    re.compile(r'repositories\/{owner}\/{repo}/issues\/(\d+)\/attachments(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
+                    'repositories/{owner}/{repo}/components'.format(owner=owner, repo=repo),
+                    'repositories/{owner}/{repo}/milestones'.format(owner=owner, repo=repo),
+                    'repositories/{owner}/{repo}/refs'.format(owner=owner, repo=repo),
+                    'repositories/{owner}/{repo}/refs/branches'.format(owner=owner, repo=repo),
+                    'repositories/{owner}/{repo}/versions'.format(owner=owner, repo=repo),
+                    'repositories/{owner}/{repo}/watchers'.format(owner=owner, repo=repo),
                 ], 
                 'rewrites':[
                     {
@@ -1779,15 +2403,15 @@ class BitBucketExport(object):
             # endpoints that take a max pagelen of 100 and should be sorted by creation date
             {
                 'endpoint_match':[
-                    re.compile(r'repositories\/{owner}\/{repo}/pullrequests\/(\d+)\/comments(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
-                    re.compile(r'repositories\/{owner}\/{repo}/pullrequests\/(\d+)\/statuses(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
-                    re.compile(r'repositories\/{owner}\/{repo}/issues\/(\d+)\/comments(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
-                    re.compile(r'repositories\/{owner}\/{repo}/commit\/(.+?)\/comments(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
-                    re.compile(r'repositories\/{owner}\/{repo}/commit\/(.+?)\/statuses(\?*)(?!\/).*'.format(owner=self.__owner, repo=self.__repository)),
-                    re.compile(r'repositories\/{owner}\/{repo}/commits\/.*'.format(owner=self.__owner, repo=self.__repository)),
-                    'repositories/{owner}/{repo}/commits'.format(owner=self.__owner, repo=self.__repository),
-                    'repositories/{owner}/{repo}/forks'.format(owner=self.__owner, repo=self.__repository),
-                    'repositories/{owner}/{repo}/issues'.format(owner=self.__owner, repo=self.__repository),
+                    re.compile(r'repositories\/{owner}\/{repo}/pullrequests\/(\d+)\/comments(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
+                    re.compile(r'repositories\/{owner}\/{repo}/pullrequests\/(\d+)\/statuses(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
+                    re.compile(r'repositories\/{owner}\/{repo}/issues\/(\d+)\/comments(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
+                    re.compile(r'repositories\/{owner}\/{repo}/commit\/(.+?)\/comments(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
+                    re.compile(r'repositories\/{owner}\/{repo}/commit\/(.+?)\/statuses(\?*)(?!\/).*'.format(owner=owner, repo=repo)),
+                    re.compile(r'repositories\/{owner}\/{repo}/commits\/.*'.format(owner=owner, repo=repo)),
+                    'repositories/{owner}/{repo}/commits'.format(owner=owner, repo=repo),
+                    'repositories/{owner}/{repo}/forks'.format(owner=owner, repo=repo),
+                    'repositories/{owner}/{repo}/issues'.format(owner=owner, repo=repo),
                 ], 
                 'rewrites':[
                     {
@@ -1807,7 +2431,7 @@ class BitBucketExport(object):
             # endpoints that take a max pagelen of 5000
             {
                 'endpoint_match':[
-                    re.compile(r'repositories\/{owner}\/{repo}\/diffstat\/.*'.format(owner=self.__owner, repo=self.__repository)),
+                    re.compile(r'repositories\/{owner}\/{repo}\/diffstat\/.*'.format(owner=owner, repo=repo)),
                 ], 
                 'rewrites':[
                     {
@@ -1822,42 +2446,60 @@ class BitBucketExport(object):
             },
         ]
 
-        self.url_queue = queue.Queue()
-        self.url_queue.put(('https://api.bitbucket.org/2.0/repositories/{owner}/{repo}'.format(owner=self.__owner, repo=self.__repository), self.__tree))
-
-        # Backup everything
-        while not self.url_queue.empty() and not ABORT_EVENT.is_set():
-            url, tree = self.url_queue.get()
-            self.get_and_save_json(url, ignore_rules + pr_ignores, rewrite_rules, tree)
-        self.tree_increment_level()
-
-    @property
-    def current_tree_location(self):
-        return self.__current_tree_location
-
-    @current_tree_location.setter
-    def current_tree_location(self, value):
-        self.__current_tree_location = value
-
-    def tree_new_level(self):
-        self.current_tree_location += (0,)
-
-    def tree_finished_level(self):
-        self.current_tree_location = self.current_tree_location[:-1]
-
-    def tree_increment_level(self):
-        self.current_tree_location = (*self.current_tree_location[:-1], self.current_tree_location[-1]+1)
+        ignore_rules = BitBucketExport.compile_ignore_rules(ignore_rules + pr_ignores)
+        rewrite_rules = BitBucketExport.compile_rewrite_rules(rewrite_rules)
+        return file_regex, issue_regex, ignore_rules, rewrite_rules
+
+    @staticmethod
+    def compile_ignore_rules(rules):
+        # Returns a function that returns True if an endpoint matches any of the ignore rules.
+        # The rules are grouped by type so that each group is checked with a single call (str.startswith and
+        # str.endswith accept a tuple of strings, and the strings to look for are combined into one regex)
+        contains = [rule['string'] for rule in rules if rule['type'] == 'in' and not rule['not']]
+        contains = re.compile('|'.join(re.escape(s) for s in contains)).search if contains else lambda endpoint: False
+        not_contains = tuple(rule['string'] for rule in rules if rule['type'] == 'in' and rule['not'])
+        startswith = tuple(rule['string'] for rule in rules if rule['type'] == 'startswith' and not rule['not'])
+        not_startswith = tuple(rule['string'] for rule in rules if rule['type'] == 'startswith' and rule['not'])
+        endswith = tuple(rule['string'] for rule in rules if rule['type'] == 'endswith' and not rule['not'])
+        not_endswith = tuple(rule['string'] for rule in rules if rule['type'] == 'endswith' and rule['not'])
+
+        def ignored(endpoint):
+            return (
+                endpoint.startswith(startswith)
+                or endpoint.endswith(endswith)
+                or contains(endpoint)
+                or any(not endpoint.startswith(s) for s in not_startswith)
+                or any(not endpoint.endswith(s) for s in not_endswith)
+                or any(s not in endpoint for s in not_contains)
+            )
+        # the same endpoints are referenced from many responses
+        return functools.lru_cache(4096)(ignored)
+
+    @staticmethod
+    def compile_rewrite_rules(rules):
+        # Splits each rule's endpoint matches into a set of strings (checked in O(1)) and a list of regexes
+        return [
+            (
+                {m for m in rule['endpoint_match'] if isinstance(m, str)},
+                [m for m in rule['endpoint_match'] if isinstance(m, re.Pattern)],
+                rule['rewrites'],
+            )
+            for rule in rules
+        ]
 
     def rewrite_url(self, endpoint, params, rules):
-        params = copy.deepcopy(params)
-        for rule in rules:
-            endpoint_matches = False
-            for endpoint_match in rule['endpoint_match']:
-                if (isinstance(endpoint_match, str) and endpoint == endpoint_match) or (isinstance(endpoint_match, re.Pattern) and endpoint_match.findall(endpoint)):
-                    endpoint_matches = True
-                    break
-            if endpoint_matches:
-                for rewrite in rule['rewrites']:
+        # rules should be the output of compile_rewrite_rules. Results are cached (see __backup_api for where the cache is reset)
+        key = (endpoint, tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in params.items())))
+        cached = self.__rewrite_cache.get(key, None)
+        if cached is None:
+            cached = self.__rewrite_cache[key] = self.__rewrite_url(endpoint, params, rules)
+        return cached[0], dict(cached[1])
+
+    def __rewrite_url(self, endpoint, params, rules):
+        params = dict(params)
+        for endpoint_strings, endpoint_patterns, rewrites in rules:
+            if endpoint in endpoint_strings or any(endpoint_match.search(endpoint) for endpoint_match in endpoint_patterns):
+                for rewrite in rewrites:
                     do_rewrite = True
                     for match_param_name, match_param_value in rewrite['params_match'].items():
                         if match_param_value == '*':
@@ -1876,40 +2518,44 @@ class BitBucketExport(object):
                             if rewrite_param_value is None and rewrite_param_name in params:
                                 del params[rewrite_param_name]
                             else:
-                                if isinstance(rewrite_param_value, (list, dict)):
-                                    rewrite_param_value = copy.deepcopy(rewrite_param_value)
+                                if isinstance(rewrite_param_value, list):
+                                    rewrite_param_value = list(rewrite_param_value)
+                                elif isinstance(rewrite_param_value, dict):
+                                    rewrite_param_value = dict(rewrite_param_value)
                                 params[rewrite_param_name] = rewrite_param_value
 
         return endpoint, params
 
     def __print_update(self, end="\r", force=False):
-        if time.time()-self.__time_of_last_update > 0.25 or force:
+        if force or time.monotonic()-self.__time_of_last_update > UPDATE_INTERVAL:
             message = '{}/{}: Downloaded {} files ({} already downloaded, skipped {} duplicate URLs)'.format(self.__owner, self.__repository, self.__files_downloaded, self.__already_downloaded, self.__duplicates_skipped)
             self.__post_message('update', (message, end, force))
             # print(message, end=end)
-            self.__time_of_last_update = time.time()
+            self.__time_of_last_update = time.monotonic()
+
+    def __record_error(self, message=None):
+        # the request didn't give us a file after all
+        if message is not None:
+            self.__post_message('update', ('{repo}: ERROR: {message}'.format(repo=self.__repo_full_name, message=message), "\n"))
+        self.__files_downloaded -= 1
+        self.__print_update(force=True)
 
     def download_file(self, base_url, tree):
         # convert url to save path
         # remove '/' before the decode as the ones that exist prior to the decode as real characters
         #  (aka the '/' in the address, not query params) shouldn't be removed
-        corrected_url_path = parse.unquote(base_url.replace(r'%2F', r'')).replace(bitbucket_api_url, '').replace('https://', '').replace('http://', '')
-        # special_chars = ['?', ':', '\\', '*','<', '>', '"', '|']
-        # for c in special_chars:
-        #     corrected_url_path = corrected_url_path.replace(c,'')
-        corrected_url_path = str(corrected_url_path).strip().replace(' ', '_')
-        corrected_url_path = re.sub(r'(?u)[^-\w.\/\=\%\{\}]', '', corrected_url_path)
+        corrected_url_path = url_scheme_prefixes.sub('', parse.unquote(base_url.replace(r'%2F', r'')))
+        corrected_url_path = corrected_url_path.strip().replace(' ', '_')
+        # (this also removes characters that aren't valid in paths on Windows, like '?', ':', '*', '<', '>', '"' and '|')
+        corrected_url_path = unsafe_path_characters.sub('', corrected_url_path)
         save_path = os.path.join(self.__save_path, corrected_url_path)
 
         # save this URL in the tree
-        # tree = self.__tree
-        # for i in self.current_tree_location[:-1]:
-        #     tree = tree[i]['children']
         tree.append({'url': base_url, 'rewritten_url': base_url, 'endpoint_path':save_path, 'already_processed': False, 'children': []})
 
 
         # don't download if it is already downloaded
-        if os.path.exists(save_path):
+        if save_path in self.__downloaded:
             response = DummyResponse(save_path, self.__dummy_response_cache)
             if response.already_processed:
                 self.__duplicates_skipped += 1
@@ -1922,23 +2568,22 @@ class BitBucketExport(object):
             return
 
         # create the dir structure
-        head, _ = os.path.split(save_path)
-        try:
-            os.makedirs(head)
-        except FileExistsError:
-            pass
+        self.__downloaded.make_parent_dirs(save_path)
 
-        r = requests.get(base_url, stream=True)
-        with open(save_path, 'wb') as fd:
-            for chunk in r.iter_content(1024**2): # 1Mb chunk size
-                fd.write(chunk)
+        with self.__session.get(base_url, stream=True) as r:
+            r.raw.decode_content = True
+            # (chunks at least as large as the buffer are written straight through it)
+            with atomic_open(save_path, 'wb') as fd:
+                shutil.copyfileobj(r.raw, fd, 1024**2) # 1Mb chunk size
+        self.__downloaded.add(save_path, base_url)
 
         DummyResponse(save_path, self.__dummy_response_cache)
 
         self.__files_downloaded += 1
         self.__print_update()
 
-    def get_and_save_json(self, base_url, ignore_rules, rewrite_rules, tree):
+    def plan_json_request(self, base_url, rewrite_rules):
+        # Returns the rewritten endpoint, the URL to query and the path the data should be saved to
         endpoint, params = full_url_to_query(base_url)
         endpoint = endpoint.replace(bitbucket_api_url, '')
         endpoint = endpoint.split('?')[0]
@@ -1947,18 +2592,15 @@ class BitBucketExport(object):
         encoded_rewritten_params = parse.urlencode(rewritten_params, doseq=True)
 
         # modify rewritten URL for save path (does not modify the URL being queried)
-        endpoint_simplified_params = copy.deepcopy(rewritten_params)
-        # we don't need the sort order in the save path
-        if "sort" in endpoint_simplified_params:
-            del endpoint_simplified_params['sort']
-        # I think that some API urls use ctx for pagination
-        # If so, we don't want to delete the ctx if there is no other indication of pagination
-        if "page" in endpoint_simplified_params and "ctx" in endpoint_simplified_params:
-            del endpoint_simplified_params['ctx']
-        # This information is stored inside the file anyway, and every URL should be being grabbed with the 
-        # largest number of items per page anyway (to reduce the number of API calls we need to make)
-        if "pagelen" in endpoint_simplified_params:
-            del endpoint_simplified_params['pagelen']
+        # * we don't need the sort order in the save path
+        # * I think that some API urls use ctx for pagination
+        #   If so, we don't want to delete the ctx if there is no other indication of pagination
+        # * pagelen is stored inside the file anyway, and every URL should be being grabbed with the 
+        #   largest number of items per page anyway (to reduce the number of API calls we need to make)
+        endpoint_simplified_params = {
+            k: v for k, v in rewritten_params.items()
+            if k not in ('sort', 'pagelen') and not (k == 'ctx' and 'page' in rewritten_params)
+        }
         endpoint_simplified_params_str = parse.urlencode(endpoint_simplified_params, doseq=True)
         endpoint_path = os.path.join(self.__save_path, rewritten_endpoint)
         if endpoint_simplified_params_str:
@@ -1970,21 +2612,20 @@ class BitBucketExport(object):
         rewritten_base_url = bitbucket_api_url + rewritten_endpoint
         if encoded_rewritten_params:
             rewritten_base_url += '?' + encoded_rewritten_params
+        return rewritten_endpoint, rewritten_base_url, endpoint_path
+
+    def get_and_save_json(self, base_url, ignore_rules, rewrite_rules, tree):
+        rewritten_endpoint, rewritten_base_url, endpoint_path = self.plan_json_request(base_url, rewrite_rules)
+        prefetched = self.__prefetched.pop(base_url, None)
+        self.__prefetched_paths.discard(endpoint_path)
 
         # save this URL in the tree
-        # tree = self.__tree
-        # for i in self.current_tree_location[:-1]:
-        #     tree = tree[i]['children']
         tree.append({'url': base_url, 'rewritten_url': rewritten_base_url, 'endpoint_path':endpoint_path, 'already_processed': False, 'children': []})
 
         # create the dir structure
-        head, _ = os.path.split(endpoint_path)
-        try:
-            os.makedirs(head)
-        except FileExistsError:
-            pass
+        self.__downloaded.make_parent_dirs(endpoint_path)
 
-        if os.path.exists(endpoint_path):
+        if endpoint_path in self.__downloaded or endpoint_path in self.__dummy_response_cache:
             # load the file
             response = DummyResponse(endpoint_path, self.__dummy_response_cache)
             if response.already_processed:
@@ -1995,212 +2636,243 @@ class BitBucketExport(object):
                 return
             else:
                 self.__already_downloaded += 1
+                # If we saved the links in this file when it was downloaded, we don't need to load and search it again
+                if endpoint_path + '.refs' in self.__downloaded:
+                    self.__queue_references(load_json_file(endpoint_path + '.refs'), ignore_rules, tree[-1]['children'])
+                    return
         else:
-            response = bb_query_api(rewritten_base_url, auth=self.__credentials)
+            if prefetched is not None:
+                response = prefetched.result()
+            else:
+                response = bb_query_api(rewritten_base_url, auth=self.__credentials, session=self.__session)
             self.__files_downloaded += 1
             self.__print_update()
 
         if response.status_code == 200:
             # save the data
             try:
-                json_data = response.json()
+                content = response.content
+                json_data = loads_json(content)
             except BaseException:
                 # print('Not a JSON response, ignoring')
                 # print('     original endpoint:', base_url)
                 # print('    rewritten endpoint:', rewritten_base_url)
                 # print('    data:', response.text)
-                self.__files_downloaded -= 1
-                self.__print_update(force=True)
+                self.__record_error()
                 return
         
-            with open(endpoint_path, 'w') as f:
-                json.dump(json_data, f)
+            refs = self.find_references(self.file_regex, content, json_data)
+
+            # Written in the background. Until it has been written, the DummyResponse below is what tells us we
+            # have this file if we encounter it again. (Files from a previous run only need their .refs file adding)
+            if isinstance(response, DummyResponse):
+                json_data = None
+            self.__pending_writes.append(self.__writer.submit(self.__save_json, endpoint_path, json_data, refs, base_url))
 
             # Create dummy response now so that we don't think this file was downloaded on a previous run of the script
             # next time it is encountered on this run of the script
             DummyResponse(endpoint_path, self.__dummy_response_cache)
 
-            self.tree_new_level()
-
-            # get the other pages
-            if "next" in json_data:
-                self.url_queue.put((json_data['next'], tree[-1]['children']))
-                # self.get_and_save_json(json_data['next'], ignore_rules, rewrite_rules, tree[-1]['children'])
-                self.tree_increment_level()
-
-            # download any files references
-            for compiled_regex in self.file_download_regexes:
-                results = compiled_regex.findall(response.text)
-                for result in results:
-                    try:
-                        # print('downloading file: {}'.format(result))
-                        self.download_file(result, tree[-1]['children'])
-                        self.tree_increment_level()
-                    except BaseException:
-                        self.__post_message('update', ('{}: Failed to download file {}'.format(self.__repo_full_name, result), "\n"))
-                        # print('Failed to download file {}'.format(result))
-                        raise
-
-            # find all the other referenced API endpoints in this data and collect them too
-            results = prog.findall(response.text)
-            for result in results:
-                # hack because nothing references issue/<num>/changes for some reason
-                issue_pattern = r'repositories/{}/{}/issues/(\d+)$'.format(self.__owner, self.__repository)
-                matches = re.match(issue_pattern, result)
-                if matches:
-                    self.url_queue.put((bb_endpoint_to_full_url(result+'/changes'), tree[-1]['children']))
-                    # self.get_and_save_json(bb_endpoint_to_full_url(result+'/changes'), ignore_rules, rewrite_rules, tree[-1]['children'])
-                    self.tree_increment_level()
-
-                skip = False
-                for rule in ignore_rules:
-                    if rule['type'] == 'in':
-                        if rule['not']:
-                            skip = rule['string'] not in result
-                        else:
-                            skip = rule['string'] in result
-                    elif rule['type'] == 'startswith':
-                        if rule['not']:
-                            skip = not result.startswith(rule['string'])
-                        else:
-                            skip = result.startswith(rule['string'])
-                    elif rule['type'] == 'endswith':
-                        if rule['not']:
-                            skip = not result.endswith(rule['string'])
-                        else:
-                            skip = result.endswith(rule['string'])
-
-                    if skip:
-                        break
-
-                if skip:
-                    continue
-
-                self.url_queue.put((bb_endpoint_to_full_url(result), tree[-1]['children']))
-                # self.get_and_save_json(bb_endpoint_to_full_url(result), ignore_rules, rewrite_rules, tree[-1]['children'])
-                self.tree_increment_level()
-            
-            self.tree_finished_level()
+            self.__queue_references(refs, ignore_rules, tree[-1]['children'])
 
         elif response.status_code == 401:
-            self.__post_message('update', ('{repo}: ERROR: Access denied for endpoint {endpoint}. No data was saved. Check your credentials and access permissions.'.format(repo=self.__repo_full_name, endpoint=rewritten_endpoint), "\n"))
-            # print("ERROR: Access denied for endpoint {endpoint}. No data was saved. Check your credentials and access permissions.".format(endpoint=rewritten_endpoint))
-            self.__files_downloaded -= 1
-            self.__print_update(force=True)
+            self.__record_error('Access denied for endpoint {endpoint}. No data was saved. Check your credentials and access permissions.'.format(endpoint=rewritten_endpoint))
         elif response.status_code == 404:
-            self.__post_message('update', ('{repo}: ERROR: API endpoint {endpoint} doesn\'t exist'.format(repo=self.__repo_full_name, endpoint=rewritten_endpoint), "\n"))
-            # print("ERROR: API endpoint {endpoint} doesn't exist".format(endpoint=rewritten_endpoint, repo=self.__repository))
-            self.__files_downloaded -= 1
-            self.__print_update(force=True)
+            self.__record_error('API endpoint {endpoint} doesn\'t exist'.format(endpoint=rewritten_endpoint))
         else:
-            self.__post_message('update', ('{repo}: ERROR: Unexpected response code {code} for endpoint {endpoint}'.format(repo=self.__repo_full_name, code=response.status_code, endpoint=rewritten_endpoint), "\n"))
-            # print("ERROR: Unexpected response code {code} for endpoint {endpoint}".format(code=response.status_code, endpoint=rewritten_endpoint))
-            self.__files_downloaded -= 1
-            self.__print_update(force=True)
+            self.__record_error('Unexpected response code {code} for endpoint {endpoint}'.format(code=response.status_code, endpoint=rewritten_endpoint))
+
+    @staticmethod
+    def find_references(file_regex, content, json_data):
+        # Returns the next page, and the files and API endpoints referenced in a downloaded API response
+        refs = {'next': json_data['next'] if 'next' in json_data else None, 'files': [], 'endpoints': []}
+        for match in file_regex.finditer(content):
+            refs['files'].append(match.group(match.lastindex).decode('utf-8'))
+        # API endpoints are searched for separately, as the text matched for a file can contain them.
+        # Note: where a URL is both a file and an API endpoint (issue attachments) it is only downloaded as a file
+        files = set(refs['files'])
+        for match in api_references.finditer(content):
+            endpoint = match.group('api').decode('utf-8')
+            if bitbucket_api_url + endpoint not in files:
+                refs['endpoints'].append(endpoint)
+        return refs
+
+    def __queue_references(self, refs, ignore_rules, children):
+        # get the other pages
+        # (pagination is already a loop via the queue rather than recursion, but the next page goes to the front of
+        # the queue so all the pages of an endpoint are fetched back to back rather than interleaved with everything
+        # else that has been queued in the meantime)
+        if refs['next'] is not None:
+            self.url_queue.appendleft((refs['next'], children))
+
+        # download any files references
+        for result in refs['files']:
+            try:
+                # print('downloading file: {}'.format(result))
+                self.download_file(result, children)
+            except BaseException:
+                self.__post_message('update', ('{}: Failed to download file {}'.format(self.__repo_full_name, result), "\n"))
+                # print('Failed to download file {}'.format(result))
+                raise
+
+        # find all the other referenced API endpoints in this data and collect them too
+        for result in refs['endpoints']:
+            # hack because nothing references issue/<num>/changes for some reason
+            matches = self.issue_regex.match(result)
+            if matches:
+                self.url_queue.append((bb_endpoint_to_full_url(result+'/changes'), children))
+
+            if ignore_rules(result):
+                continue
+
+            self.url_queue.append((bb_endpoint_to_full_url(result), children))
 
-    def make_urls_relative(self, tree=None, parent_percent=0, parent_percent_subset=100.0, mapping=None):
+    def make_urls_relative(self):
         # tree.append({'url': base_url, 'rewritten_url': rewritten_base_url, 'endpoint_path':endpoint_path, 'already_processed': False, 'children': []})
-        
-        top_level = False
-        if tree is None:
-            tree = self.__tree
-            top_level = True
-            # self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {pcnt:.1f}% complete'.format(repo=self.__repo_full_name, pcnt=parent_percent), "\r"))
-            # print('Rewriting URLs in downloaded API data: {:.1f}% complete'.format(parent_percent), end="\r")
-        if len(tree):
-            parent_percent_subset = parent_percent_subset/len(tree)
-
-        for item in tree:
-            # get new path
-            new_path = item['endpoint_path'].replace(self.__save_path, self.__save_path_relative)
-            head, _ = os.path.split(new_path)
+
+        # Checking whether a file has already been converted is done against a listing of its directory (made once per
+        # directory), rather than a stat of every file. Nothing is written until we have finished walking the tree
+        listings = {}
+        def converted(path):
+            head, tail = os.path.split(path)
+            if head not in listings:
+                try:
+                    with os.scandir(head) as entries:
+                        listings[head] = {entry.name for entry in entries}
+                except FileNotFoundError:
+                    listings[head] = set()
+            return tail in listings[head]
+
+        # walk the tree with an explicit stack to find the files that need converting
+        files = {}
+        stack = deque([self.__tree])
+        while stack and not ABORT_EVENT.is_set():
+            for item in stack.pop():
+                # get new path
+                new_path = item['new_path'] = item['endpoint_path'].replace(self.__save_path, self.__save_path_relative)
+                # references to this item (in the file of its parent) are replaced with the relative URL (see __rewrite_file)
+                new_url = item['endpoint_path'].replace(self.__save_path, 'data').translate(url_path_separators)
+                item['url_rewrite'] = (item['url'].encode('utf-8'), new_url.encode('utf-8'))
+                stack.append(item['children'])
+
+                # ignore if new path already converted (or will be)
+                if new_path in files or converted(new_path):
+                    continue
+                # ignore if file doesn't exist
+                if item['endpoint_path'] not in self.__downloaded:
+                    continue
+                # only process the items that have children (we may encounter reference to a file that was marked as already processed)
+                # before we hit the reference that was not marked as already processed.
+                if item['already_processed'] and new_path.endswith('.json'):
+                    continue
+                files[new_path] = item
+
+        # create each output directory once, rather than once per file
+        for head in {os.path.dirname(new_path) for new_path in files}:
+            os.makedirs(head, exist_ok=True)
+
+        # each file is rewritten independently of the others, so they can be done concurrently
+        self.__rewritten_json = OrderedDict()
+        self.__rewritten_json_lock = threading.Lock()
+        rewrite_count = 0
+        time_of_last_update = time.monotonic()-1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FILE_IO) as executor:
+            futures = [executor.submit(self.__rewrite_file, item) for item in files.values()]
             try:
-                os.makedirs(head)
-            except FileExistsError:
-                pass
-
-            skip_file = False
-            # ignore if new path already converted
-            if os.path.exists(new_path):
-                skip_file = True
-            # ignore if file doesn't exist
-            if not os.path.exists(item['endpoint_path']):
-                skip_file = True
-            # only process the items that have children (we may encounter reference to a file that was marked as already processed)
-            # before we hit the reference that was not marked as already processed.
-            if item['already_processed'] and new_path.endswith('.json'):
-                skip_file = True
-
-            if not skip_file:
-                # if it is a JSON file
-                if new_path.endswith('.json'):
-                    # open file
-                    # print('processing', item['endpoint_path'])
-                    with open(item['endpoint_path'], 'r') as f:
-                        data = f.read()
-
-                    # iterate over children and replace URLs
-                    for child in item['children']:
-                        # print('replacing', child['url'], 'with', child['endpoint_path'].replace(r'\\', '/').replace(r'\','/'))
-                        new_url = child['endpoint_path'].replace(self.__save_path, 'data').replace('\\\\', '/').replace('\\','/')
-                        data = data.replace('"{}"'.format(child['url']), '"{}"'.format(new_url)) # JSON value
-                        data = data.replace(r'\"{}\"'.format(child['url']), r'\"{}\"'.format(new_url)) # escaped HTML image src in JSON
-                        # data = data.replace('![]({})'.format(child['url']), '![]({})'.format(new_url)) # markdown image format
-                        data = re.sub(r"\!\[(.*?)\]\("+re.escape(child['url'])+r"\)", r"![\1]("+new_url+r")", data, flags=re.MULTILINE) # markdown image format
-
-                    # fix weird URLS that exist which aren't valid api endpoints, but BitBucket puts them in the content...WTF?
-                    # data = re.sub(r'\\\"(https\:\/\/api\.bitbucket\.org\/(.*?)\/(.*?)\/(.*?))\\\"', self.fix_stupid_bitbucket_urls, data, flags=re.MULTILINE)
-                    data = re.sub(r'\\\"(https\:\/\/api\.bitbucket\.org\/(.*?)\/(.*?)((\\\")|(\/(.*?))\\\"))', self.fix_stupid_bitbucket_urls, data, flags=re.MULTILINE)
-                    data = re.sub(r'(\\\"\/.*?(\&\#109;\&\#97;\&\#105;\&\#108;\&\#116;\&\#111;\&\#58;)(.*?)\\\")', self.fix_stupid_bitbucket_email_links, data, flags=re.MULTILINE)
-
-                    # apply relevant BB to GH transformation
-                    # find repo name
-                    # apply all transformations 
-                    for name in mapping:
-                        data = data.replace('https://bitbucket.org/{}'.format(name), '#!/{}'.format(name))
-
-                    for old_url, (new_url, _) in self.__external_URL_rewrites.items():
-                        data = data.replace(old_url, new_url)
-
-                    # save file
-                    with open(new_path, 'w') as f:
-                        f.write(data)
-                # if it is a binary file
-                else:
-                    shutil.copyfile(item['endpoint_path'], new_path)
-
-            # recurse over children
-            self.url_queue.put({
-                'tree': item['children'],
-                'mapping': mapping,
-                'parent_percent': parent_percent, 
-                'parent_percent_subset': parent_percent_subset,
-            })
-            # self.make_urls_relative(item['children'], parent_percent=parent_percent, parent_percent_subset=parent_percent_subset, mapping=mapping)
-            parent_percent += parent_percent_subset
-            # self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {pcnt:.1f}% complete'.format(repo=self.__repo_full_name, pcnt=parent_percent), "\r"))
-            # print('Rewriting URLs in downloaded API data: {:.1f}% complete'.format(parent_percent), end="\r")
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    rewrite_count += 1
+                    # (backup_api posts the final count)
+                    if time.monotonic()-time_of_last_update > UPDATE_INTERVAL:
+                        self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {count} files rewritten'.format(repo=self.__repo_full_name, count=rewrite_count), "\r"))
+                        time_of_last_update = time.monotonic()
+                    if ABORT_EVENT.is_set():
+                        break
+            finally:
+                for future in futures:
+                    future.cancel()
+        return rewrite_count
+
+    def __rewrite_file(self, item):
+        # the mapping and URL rewrites are only read here, so this is safe to call from multiple threads
+        # (the new_path, url_rewrite and directories have already been prepared by make_urls_relative)
+        new_path = item['new_path']
+        # if it is a JSON file
+        if new_path.endswith('.json'):
+            # open file
+            # print('processing', item['endpoint_path'])
+            with open(item['endpoint_path'], 'rb') as f:
+                data = f.read()
+
+            # Many files are identical (e.g. empty pages), so small files are only rewritten once. The result also depends on the
+            # URLs of the children, which are normally the same for the same content but are included to be sure
+            new_urls = dict(child['url_rewrite'] for child in item['children'])
+            if len(data) < SMALL_FILE_THRESHOLD:
+                key = (hashlib.blake2b(data, digest_size=16).digest(), frozenset(new_urls.items()))
+                with self.__rewritten_json_lock:
+                    rewritten = self.__rewritten_json.get(key)
+                    if rewritten is not None:
+                        self.__rewritten_json.move_to_end(key)
+                if rewritten is None:
+                    # (small, so joined rather than keeping all the parts)
+                    rewritten = [b''.join(self.__rewrite_json(data, new_urls))]
+                    with self.__rewritten_json_lock:
+                        self.__rewritten_json[key] = rewritten
+                        if len(self.__rewritten_json) > REWRITTEN_JSON_CACHE_SIZE:
+                            self.__rewritten_json.popitem(last=False)
+                parts = rewritten
+            else:
+                parts = self.__rewrite_json(data, new_urls)
 
-        # if top_level:
-        #     self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: 100.0% complete'.format(repo=self.__repo_full_name), "\n"))
-            # print('Rewriting URLs in downloaded API data: 100.0% complete')
+            # save file
+            write_file(new_path, parts)
+        # if it is a binary file
+        else:
+            copy_file(item['endpoint_path'], new_path)
+
+    def __rewrite_json(self, data, new_urls):
+        # replace the URLs of all children in one pass (many files don't contain any, so check first)
+        if any(url in data for url in new_urls):
+            regex = child_url_references(frozenset(new_urls))
+            data = regex.sub(lambda m: self.replace_child_url(m, regex, new_urls), data)
+
+        # fix weird URLS that exist which aren't valid api endpoints, but BitBucket puts them in the content...WTF?
+        # data = re.sub(r'\\\"(https\:\/\/api\.bitbucket\.org\/(.*?)\/(.*?)\/(.*?))\\\"', self.fix_stupid_bitbucket_urls, data, flags=re.MULTILINE)
+        if b'https://api.bitbucket.org/' in data:
+            data = stupid_bitbucket_urls.sub(self.fix_stupid_bitbucket_urls, data)
+        if b'&#109;&#97;&#105;&#108;&#116;&#111;&#58;' in data:
+            data = stupid_bitbucket_email_links.sub(self.fix_stupid_bitbucket_email_links, data)
+
+        # apply relevant BB to GH transformation and the external URL rewrites
+        if self.__url_rewrites:
+            return multi_replace(data, self.__url_rewrites_regex, self.__url_rewrites)
+        return [data]
+
+    @staticmethod
+    def replace_child_url(matchobj, regex, new_urls):
+        if matchobj.group('url') is not None:
+            return b'%s%s%s' % (matchobj.group('quote'), new_urls[matchobj.group('url')], matchobj.group('quote'))
+        # The alt text of a markdown image is matched lazily up to the first '](<URL>)', so it can contain other
+        # references (or even other images). Rewrite those too
+        alt = regex.sub(lambda m: BitBucketExport.replace_child_url(m, regex, new_urls), matchobj.group('alt'))
+        return b'![%s](%s)' % (alt, new_urls[matchobj.group('markdown_url')])
 
     def fix_stupid_bitbucket_urls(self, matchobj):
         # If the URL matches one of the respositories we are backing up, rewrite it to point to the correct
         # static HTML page
-        if (matchobj.group(2), matchobj.group(3)) in self.__repository_list:
-            return r'\"#!/{m2}/{m3}{m4}'.format(m2=matchobj.group(2), m3=matchobj.group(3), m4=matchobj.group(4))
+        if (matchobj.group(2).decode('utf-8'), matchobj.group(3).decode('utf-8')) in self.__repository_list:
+            return rb'\"#!/%s/%s%s' % (matchobj.group(2), matchobj.group(3), matchobj.group(4))
         else:
             # it's a link to repository that we are not backing up. We'll redirect it to the actual bitbucket website for posterity,
             # although it is unlikely the URL will exist beyond the BitBucket shutdown. It's possible the owner will put up a redirect
             # at some point though!
-            if 'https://api.bitbucket.org/2.0/' not in matchobj.group(0) and 'https://api.bitbucket.org/1.0/' not in matchobj.group(0):
-                return matchobj.group(0).replace('https://api.bitbucket.org', 'https://bitbucket.org')
+            if b'https://api.bitbucket.org/2.0/' not in matchobj.group(0) and b'https://api.bitbucket.org/1.0/' not in matchobj.group(0):
+                return matchobj.group(0).replace(b'https://api.bitbucket.org', b'https://bitbucket.org')
             # otherwise it's an API endpoint that exists in HTML code. So we'll leave it, as it was probably put there deliberately by a user, not the BitBucket API
             return matchobj.group(0)
 
     def fix_stupid_bitbucket_email_links(self, matchobj):
-        return r'\"mailto:{}\"'.format(html.unescape(matchobj.group(3)))
+        return rb'\"mailto:%s\"' % html.unescape(matchobj.group(3).decode('utf-8')).encode('utf-8')
 
 
 class DummyResponse(object):
@@ -2212,13 +2884,17 @@ class DummyResponse(object):
         self.already_processed = False
 
     def json(self):
-        with open(self.__path, 'r') as f:
-            return json.load(f)
+        return loads_json(self.content)
+
+    @property
+    def content(self):
+        # The same instance is returned for every request of this path (see __new__), but the contents are held in a
+        # bounded cache rather than on the instance so that the cache of instances doesn't keep every file in memory
+        return read_file_bytes(self.__path)
 
     @property
     def text(self):
-        with open(self.__path, 'r') as f:
-            return f.read()
+        return self.content.decode('utf-8')
 
     def __new__(cls, path, cache, *args, **kwargs):
         existing = cache.get(path, None)
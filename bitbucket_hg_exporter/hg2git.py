@@ -468,8 +468,9 @@ class BbToGh(object):
         for hg_node, rest_of_url in url_pairs:
             parsed_url = urlparse.urlparse(rest_of_url)
             line = ""
-            if re.search("-\d+", parsed_url.fragment):
-                line = "#L" + re.search("-(\d+)", parsed_url.fragment).groups()[0]
+            line_match = re.search(r"-(\d+)", parsed_url.fragment)
+            if line_match is not None:
+                line = "#L" + line_match.group(1)
             git_hash = self.hgnode_to_githash(hg_node)
             if git_hash is None:
                 git_hash = "master"
@@ -182,7 +182,7 @@ def __get_items_from_file(start_file, options):
     more = True
     while more:
         try:
-            with open(os.path.join(repo_base, file_path), 'r') as f:
+            with open(os.path.join(repo_base, file_path), 'r', encoding='utf-8') as f:
                 data = json.load(f)
             for item in data['values']:
                 yield item
@@ -92,14 +92,14 @@ setup(
     },
     author='Philip Starkey',
     classifiers=['Development Status :: 3 - Alpha',
-                 'Programming Language :: Python :: 3.7',
+                 'Programming Language :: Python :: 3.8',
                  'Environment :: Console',
                  'Intended Audience :: Developers',
                  'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
                  'Natural Language :: English',
                  'Operating System :: OS Independent',
                 ],
-    python_requires='>=3.7, <4',
+    python_requires='>=3.8, <4',
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
@@ -110,6 +110,9 @@ setup(
         'colorama',
         'cffi'
     ],
+    extras_require={
+        'fast': ['orjson', 'ijson'],
+    },
     entry_points = {
         "console_scripts": [
             "bitbucket-hg-exporter = bitbucket_hg_exporter.__main__:main",
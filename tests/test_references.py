@@ -0,0 +1,32 @@
+import unittest
+
+from bitbucket_hg_exporter.__main__ import BitBucketExport
+
+
+class FindReferencesTest(unittest.TestCase):
+    def setUp(self):
+        self.file_regex = BitBucketExport.build_repository_rules('owner', 'repo')[0]
+
+    def find_references(self, content):
+        return BitBucketExport.find_references(self.file_regex, content, {})
+
+    def test_api_link_inside_file_match(self):
+        # the image src isn't closed (with \") until a later string, so the text matched for the image contains the API link
+        content = (
+            b'{"html": "<img src=\\"https://bitbucket.org/repo/abc/images/a.png>", '
+            b'"self": "https://api.bitbucket.org/2.0/repositories/owner/repo", '
+            b'"more": "<p>\\"</p>"}'
+        )
+        refs = self.find_references(content)
+        self.assertEqual(len(refs['files']), 1)
+        self.assertEqual(refs['endpoints'], ['repositories/owner/repo'])
+
+    def test_attachment_is_only_a_file(self):
+        url = 'https://api.bitbucket.org/2.0/repositories/owner/repo/issues/1/attachments/a.txt'
+        refs = self.find_references('{{"links": {{"self": "{}"}}}}'.format(url).encode('utf-8'))
+        self.assertEqual(refs['files'], [url])
+        self.assertEqual(refs['endpoints'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
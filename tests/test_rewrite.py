@@ -0,0 +1,53 @@
+import unittest
+
+from bitbucket_hg_exporter.__main__ import BitBucketExport, child_url_references
+
+
+class ReplaceChildUrlTest(unittest.TestCase):
+    new_urls = {
+        b'https://bitbucket.org/repo/abc/images/a.png': b'data/repo/abc/images/a.png',
+        b'https://api.bitbucket.org/2.0/repositories/owner/repo': b'data/repositories/owner/repo.json',
+    }
+
+    def rewrite(self, data):
+        regex = child_url_references(frozenset(self.new_urls))
+        return regex.sub(lambda m: BitBucketExport.replace_child_url(m, regex, self.new_urls), data)
+
+    def test_json_value_and_html_src(self):
+        self.assertEqual(
+            self.rewrite(b'{"self": "https://api.bitbucket.org/2.0/repositories/owner/repo", "html": "<img src=\\"https://bitbucket.org/repo/abc/images/a.png\\">"}'),
+            b'{"self": "data/repositories/owner/repo.json", "html": "<img src=\\"data/repo/abc/images/a.png\\">"}'
+        )
+
+    def test_markdown_image_with_brackets_in_alt_text(self):
+        self.assertEqual(
+            self.rewrite(b'![a [b]](https://bitbucket.org/repo/abc/images/a.png)'),
+            b'![a [b]](data/repo/abc/images/a.png)'
+        )
+
+    def test_references_inside_alt_text(self):
+        # the alt text is matched up to the first '](<URL>)', so it spans the other references here
+        self.assertEqual(
+            self.rewrite(b'![a](local.png) \\"https://bitbucket.org/repo/abc/images/a.png\\" ![b](https://example.com/b.png)'),
+            b'![a](local.png) \\"data/repo/abc/images/a.png\\" ![b](https://example.com/b.png)'
+        )
+
+    def test_markdown_image_after_a_leading_url(self):
+        self.assertEqual(
+            self.rewrite(b'{"raw": "https://example.com see ![x](https://bitbucket.org/repo/abc/images/a.png)"}'),
+            b'{"raw": "https://example.com see ![x](data/repo/abc/images/a.png)"}'
+        )
+
+    def test_html_src_after_a_leading_url(self):
+        self.assertEqual(
+            self.rewrite(b'{"html": "https://example.com <img src=\\"https://bitbucket.org/repo/abc/images/a.png\\">"}'),
+            b'{"html": "https://example.com <img src=\\"data/repo/abc/images/a.png\\">"}'
+        )
+
+    def test_other_urls_are_left_alone(self):
+        data = b'{"a": "https://example.com", "b": "![x](https://example.com/x.png)"}'
+        self.assertEqual(self.rewrite(data), data)
+
+
+if __name__ == '__main__':
+    unittest.main()